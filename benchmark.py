@@ -0,0 +1,293 @@
+# This script is a benchmark suite measuring the time and memory needed to insert artefacts, usage:
+#   python ./benchmark.py [--quick] [--json results.json] [--compare baseline.json] [artefact class ...]
+# e.g. python ./benchmark.py --json before.json RulerVertical Bubble
+# It measures the startup of the ArtefactsRepository, the insertion of artefacts of each class (with and without
+# mask) into the bundled test images resized to different sizes, and the end-to-end generation of a dataset. Each
+# part runs in a fresh process, so the reported peak memory belongs to it. Results can be written as json and
+# compared to the results of an earlier run (--compare), --quick skips the large image sizes.
+# Single parts can be run as well:
+#   python ./benchmark.py --memory                       repository startup only
+#   python ./benchmark.py --batch [artefact class ...]   throughput of Artefact.apply_batch vs. single calls
+
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from src.dataset import DatasetIndex
+from src.generation import generate_dataset, link_or_copy
+from src.repository import ArtefactsRepository
+from src.types import *
+
+META_FILE = 'data/artefacts/meta.json'
+TEST_IMAGES_DIR = 'data/test_images'
+TEST_MASKS_DIR = 'data/test_masks'
+
+CLASSES = [Bubble, MarkingSpot, MarkingCircle, RulerHorizontal, RulerVertical]
+
+# image sizes (width, height) the test images and their masks are resized to, and the number of calls measured
+SIZES = {(600, 450): 20, (1024, 1024): 10, (2048, 2048): 5, (4096, 4096): 3}
+QUICK_SIZES = [(600, 450), (1024, 1024)]
+GENERATION_COPIES = 4  # the test images are used this many times (as different images) to generate a dataset
+BATCH_SIZE = 32
+
+
+def memory_usage():
+    """Peak resident set size (of this process or of its finished child processes, whichever is larger) and
+    current private (not shared) memory of this process in MiB, the latter is only available on linux."""
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+    private = float('nan')
+    try:
+        with open('/proc/self/smaps_rollup') as smaps:
+            private = sum(int(line.split()[1]) for line in smaps if line.startswith('Private_')) / 1024
+    except OSError:
+        pass
+    return peak, private
+
+
+def summarize(times):
+    """Latency percentiles (in ms) and throughput of the given wall times (in seconds)."""
+    times = np.array(times) * 1000
+    return {'calls': len(times), 'mean_ms': float(times.mean()), 'p50_ms': float(np.percentile(times, 50)),
+            'p90_ms': float(np.percentile(times, 90)), 'p99_ms': float(np.percentile(times, 99)),
+            'images_per_s': float(1000 / times.mean())}
+
+
+def _isolated_worker(function, args, queue):
+    queue.put(function(*args))
+
+
+def isolated(function, *args):
+    """Runs function(*args) in a fresh (spawned) process and returns its result."""
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_isolated_worker, args=(function, args, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def test_pairs(size=None):
+    """Loads all bundled test images and their masks, resized to size (width, height) if given."""
+    pairs = []
+    for image_path, mask_path in DatasetIndex(TEST_IMAGES_DIR, TEST_MASKS_DIR).pairs():
+        image, mask = Image.open(image_path), Image.open(mask_path)
+        if size is not None:
+            image, mask = image.resize(size), mask.resize(size, Image.NEAREST)
+        image.load(), mask.load()
+        pairs.append((image, mask))
+    return pairs
+
+
+def benchmark(repo, artefact_class, pairs, use_mask, repeat):
+    """Applies artefacts of the given class repeat times, cycling through the given images, and returns the wall
+    times in seconds. Artefacts are selected with fixed seeds, so runs are comparable."""
+    times = []
+    for i in range(repeat):
+        image, mask = pairs[i % len(pairs)]
+        artefact = repo.get_random_instance(artefact_class, seed=i)
+        start = time.perf_counter()
+        artefact(image, mask if use_mask else None)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def benchmark_insertion(size, class_names, repeat):
+    """Measures the insertion of artefacts of all given classes (with and without mask) into the test images
+    resized to size, meant to run in its own process (see isolated)."""
+    repo = ArtefactsRepository(META_FILE, seed=2022)
+    pairs = test_pairs(size)
+    results = []
+    for name in class_names:
+        for use_mask in (True, False):
+            benchmark(repo, globals()[name], pairs, use_mask, 1)  # warm up (e.g. cached beta factors)
+            result = {'benchmark': 'insert', 'case': f'{name} {size[0]}x{size[1]} {"mask" if use_mask else "no mask"}',
+                      'class': name, 'size': list(size), 'mask': use_mask}
+            result.update(summarize(benchmark(repo, globals()[name], pairs, use_mask, repeat)))
+            results.append(result)
+    peak, _ = memory_usage()
+    for result in results:
+        result['peak_rss_mib'] = peak
+    return results
+
+
+def benchmark_startup(name, repository_kwargs):
+    """Measures the time needed to create a repository and to insert the first artefact, and the memory used
+    afterwards, meant to run in its own process (see isolated)."""
+    start = time.perf_counter()
+    repo = ArtefactsRepository(META_FILE, seed=2022, **repository_kwargs)
+    created = time.perf_counter()
+    image, mask = test_pairs()[0]
+    repo.get_random_instance(Bubble)(image, mask)
+    first = time.perf_counter()
+    peak, private = memory_usage()
+    return {'benchmark': 'startup', 'case': name, 'startup_ms': (created - start) * 1000,
+            'first_call_ms': (first - created) * 1000, 'peak_rss_mib': peak, 'private_mib': private}
+
+
+def benchmark_generation(workers):
+    """Measures the end-to-end generation of a dataset (reading, inserting one artefact of each class and writing)
+    from copies of the test images, meant to run in its own process (see isolated)."""
+    with tempfile.TemporaryDirectory() as target:
+        pairs = []
+        for copy in range(GENERATION_COPIES):
+            for image_path, mask_path in DatasetIndex(TEST_IMAGES_DIR, TEST_MASKS_DIR).pairs():
+                name = f'{os.path.splitext(os.path.basename(image_path))[0]}_{copy}'
+                os.mkdir(os.path.join(target, name))
+                image_target = os.path.join(target, name + os.path.splitext(image_path)[1])
+                mask_target = os.path.join(target, name, 'mask' + os.path.splitext(mask_path)[1])
+                link_or_copy(image_path, image_target)
+                link_or_copy(mask_path, mask_target)
+                pairs.append((image_target, mask_target, os.path.join(target, name)))
+
+        artefact_classes = [('bubble.png', Bubble), ('ruler.png', Ruler), ('marking.png', Marking)]
+        start = time.perf_counter()
+        for _ in generate_dataset(pairs, META_FILE, artefact_classes, root_seed=2022, workers=workers):
+            pass
+        duration = time.perf_counter() - start
+    peak, _ = memory_usage()
+    return {'benchmark': 'generate', 'case': f'{workers} workers', 'workers': workers, 'images': len(pairs),
+            'total_s': duration, 'images_per_s': len(pairs) / duration, 'peak_rss_mib': peak}
+
+
+def run_startup():
+    results = []
+    with tempfile.TemporaryDirectory() as store:
+        ArtefactsRepository(META_FILE, template_cache=store, lazy=True)  # build the store once
+        configurations = [('eager', {}),
+                          ('eager, template store', {'template_cache': store}),
+                          ('lazy, template store', {'template_cache': store, 'lazy': True})]
+
+        print(f'{"repository":<24} {"startup [ms]":>13} {"1st call [ms]":>14} {"peak RSS [MiB]":>15} '
+              f'{"private [MiB]":>14}')
+        for name, kwargs in configurations:
+            result = isolated(benchmark_startup, name, kwargs)
+            print(f'{name:<24} {result["startup_ms"]:13.1f} {result["first_call_ms"]:14.1f} '
+                  f'{result["peak_rss_mib"]:15.1f} {result["private_mib"]:14.1f}')
+            results.append(result)
+    return results
+
+
+def run_insertion(sizes, class_names):
+    results = []
+    print(f'{"class":<16} {"size":>10} {"mask":>5} {"p50 [ms]":>9} {"p90 [ms]":>9} {"p99 [ms]":>9} '
+          f'{"img/s":>7} {"peak RSS [MiB]":>15}')
+    for size in sizes:
+        for result in isolated(benchmark_insertion, size, class_names, SIZES[size]):
+            print(f'{result["class"]:<16} {"%dx%d" % size:>10} {str(result["mask"]):>5} {result["p50_ms"]:9.1f} '
+                  f'{result["p90_ms"]:9.1f} {result["p99_ms"]:9.1f} {result["images_per_s"]:7.1f} '
+                  f'{result["peak_rss_mib"]:15.1f}')
+            results.append(result)
+    return results
+
+
+def run_generation():
+    results = []
+    print(f'{"generation":<24} {"images":>7} {"total [s]":>10} {"img/s":>7} {"peak RSS [MiB]":>15}')
+    for workers in sorted({1, os.cpu_count() or 1}):
+        result = isolated(benchmark_generation, workers)
+        print(f'{result["case"]:<24} {result["images"]:7d} {result["total_s"]:10.2f} {result["images_per_s"]:7.2f} '
+              f'{result["peak_rss_mib"]:15.1f}')
+        results.append(result)
+    return results
+
+
+def compare(results, baseline_path):
+    """Prints the change of the main metric of each benchmark case relative to an earlier run."""
+    with open(baseline_path) as baseline_file:
+        baseline = {(r['benchmark'], r['case']): r for r in json.load(baseline_file)['results']}
+    metrics = {'insert': 'p50_ms', 'startup': 'startup_ms', 'generate': 'images_per_s'}
+
+    print(f'\ncompared to {baseline_path}:')
+    print(f'{"benchmark":<10} {"case":<34} {"metric":<13} {"before":>9} {"after":>9} {"change":>8}')
+    for result in results:
+        before = baseline.get((result['benchmark'], result['case']))
+        if before is None:
+            continue
+        metric = metrics[result['benchmark']]
+        change = (result[metric] / before[metric] - 1) * 100
+        print(f'{result["benchmark"]:<10} {result["case"]:<34} {metric:<13} {before[metric]:9.1f} '
+              f'{result[metric]:9.1f} {change:+7.1f}%')
+
+
+def benchmark_batch(repo, artefact_class, images, masks):
+    """Inserts artefacts of the given class into a batch of images, once by calling the artefact for each image
+    (converting from and to ndarrays, as a data loader would) and once using apply_batch.
+
+    :return: throughput of both variants in images/s
+    """
+    artefact = repo.get_random_instance(artefact_class)
+    seeds = range(len(images))
+
+    start = time.perf_counter()
+    for image, mask, seed in zip(images, masks, seeds):
+        artefact.reseed(seed)
+        np.asarray(artefact(Image.fromarray(image), mask))
+    single = len(images) / (time.perf_counter() - start)
+
+    out = np.empty_like(images)
+    start = time.perf_counter()
+    artefact.apply_batch(images, masks, seeds, out=out)
+    batch = len(images) / (time.perf_counter() - start)
+    return single, batch
+
+
+def run_batch(class_names):
+    repo = ArtefactsRepository(META_FILE, seed=2022)
+    test_image, test_mask = test_pairs()[0]
+
+    print(f'{"class":<16} {"size":>10} {"mask":>5} {"single [img/s]":>15} {"batch [img/s]":>14}')
+    for size in QUICK_SIZES + [(2048, 2048)]:
+        images = np.stack([np.asarray(test_image.resize(size))] * BATCH_SIZE)
+        mask = np.asarray(test_mask.resize(size, Image.NEAREST))
+        for name in class_names:
+            for masks in ([mask] * BATCH_SIZE, [None] * BATCH_SIZE):
+                single, batch = benchmark_batch(repo, globals()[name], images, masks)
+                print(f'{name:<16} {"%dx%d" % size:>10} {str(masks[0] is not None):>5} '
+                      f'{single:15.1f} {batch:14.1f}')
+
+
+def option(name):
+    """Value following the command line option name, or None."""
+    if name not in sys.argv:
+        return None
+    return sys.argv[sys.argv.index(name) + 1]
+
+
+if __name__ == "__main__":
+
+    arguments = sys.argv[1:]
+    for name in ('--json', '--compare'):
+        if name in arguments:
+            del arguments[arguments.index(name):arguments.index(name) + 2]
+    class_names = [a for a in arguments if not a.startswith('--')] or [c.__name__ for c in CLASSES]
+
+    if '--memory' in sys.argv:
+        run_startup()
+        sys.exit()
+    if '--batch' in sys.argv:
+        run_batch(class_names)
+        sys.exit()
+
+    results = run_startup()
+    print()
+    results += run_insertion(QUICK_SIZES if '--quick' in sys.argv else list(SIZES), class_names)
+    print()
+    results += run_generation()
+
+    if option('--json') is not None:
+        with open(option('--json'), 'w') as json_file:
+            json.dump({'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                                   'numpy': np.__version__, 'cpus': os.cpu_count()},
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}, json_file, indent=2)
+    if option('--compare') is not None:
+        compare(results, option('--compare'))
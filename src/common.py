@@ -1,7 +1,15 @@
+import hashlib
+import os
 import random
+import tempfile
+from collections import OrderedDict
+from copy import copy
+from functools import lru_cache
+
 from PIL import Image
 
 import numpy as np
+from scipy import ndimage
 from scipy.special import gamma
 
 
@@ -11,6 +19,37 @@ def to_image(ndarray):
     return Image.fromarray(np.uint8(ndarray))
 
 
+def to_array(ndarray, out=None):
+    """Same as to_image, but the result is an uint8 ndarray (written to out, if given) and ndarray is not modified.
+
+    :param ndarray: image as integer ndarray
+    :param out: optional uint8 ndarray of the same shape, e.g. a view of a shared memory buffer
+    :return: out
+    """
+    if out is None:
+        out = np.empty(ndarray.shape, dtype='uint8')
+    return np.clip(ndarray, 0, 255, out=out, casting='unsafe')
+
+
+def resize_input(image, mask, size):
+    """Resizes an image and its mask (using the nearest neighbour) to the given size.
+
+    :param image: PIL Image or uint8 ndarray
+    :param mask: PIL Image, ndarray or None, other objects (e.g. a PlacementContext) are returned unchanged
+    :param size: (width, height) of the result
+    :return: (resized image, resized mask, (row factor, column factor)) tuple, the image is a PIL Image
+    """
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(np.asarray(image, dtype='uint8'))
+    resolution_scale = (size[1] / image.height, size[0] / image.width)
+    image = image.resize(size)
+    if isinstance(mask, np.ndarray):
+        mask = Image.fromarray(np.asarray(mask, dtype='uint8'))
+    if isinstance(mask, Image.Image):
+        mask = mask.resize(size, Image.NEAREST)
+    return image, mask, resolution_scale
+
+
 def embed_in_image(image_target, image_source, position):
     """This function places a smaller image in a bigger one on a given position,
     where position is given as x/y coordinate and describes the position
@@ -22,39 +61,326 @@ def embed_in_image(image_target, image_source, position):
     :return: image with inserted smaller image
     """
 
-    image_target = np.array(image_target, dtype='int16')
+    return embed_in_image_inplace(np.array(image_target, dtype='int16'), image_source, position)
+
+
+def embed_in_image_inplace(image_target, image_source, position, out=None):
+    """Same as embed_in_image, but the smaller image is added to the target ndarray in place (or to out, if
+    given). Only the region of the target overlapping with image_source is touched, values exceeding the
+    range of the target dtype are cut off.
+
+    :param image_target: target image as integer ndarray
+    :param image_source: ndarray or SparseArtefact to insert
+    :param position: ndarrday of position (x,y)
+    :param out: optional ndarray (of the target shape) to write the result to instead of image_target
+    :return: out, or image_target if out is None
+    """
+
+    if out is None:
+        out = image_target
+    elif out is not image_target:
+        np.copyto(out, image_target)
+
+    if isinstance(image_source, SparseArtefact):
+        # only the nonzero pixels are changed, the result is the same as for the dense artefact
+        rows, cols, inside = image_source.target_coordinates(position, out.shape)
+        values = image_source.values if inside is None else image_source.values[inside]
+        pixel_sum = np.add(out[rows, cols], values, dtype=np.result_type(out, values, np.int32))
+        np.clip(pixel_sum, np.iinfo(out.dtype).min, np.iinfo(out.dtype).max, out=pixel_sum)
+        out[rows, cols] = pixel_sum
+        return out
+
+    region = overlap_region(out.shape, image_source.shape, position)
+    if region is None:
+        return out  # no overlap
+    target_region, source_region = region
+
+    # paste image and deal with datatype min and max values (cut em off) in the overlapping region only
+    target = out[target_region]
+    source = image_source[source_region]
+    region_sum = np.add(target, source, dtype=np.result_type(target, source, np.int32))
+    np.clip(region_sum, np.iinfo(out.dtype).min, np.iinfo(out.dtype).max, out=region_sum)
+    target[...] = region_sum
+
+    return out
+
+
+def derive_seed(*parts):
+    """Derives a seed from the given parts (e.g. a root seed, an image id and an artefact class name).
+    Unlike hash() the result is stable across processes and runs.
+
+    :param parts: values with a stable string representation
+    :return: int
+    """
+    digest = hashlib.sha256('/'.join(str(p) for p in parts).encode()).digest()
+    return int.from_bytes(digest[:8], 'little')
+
+
+def atomic_write(file_path, write):
+    """Writes a file by calling write with a temporary file in the same folder, which then replaces file_path. Readers
+    thereby see either the previous or the complete new file, and no partial file is left if writing fails.
+
+    :param file_path: location of the file
+    :param write: function writing the content to the given binary file object
+    """
+    handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)))
+    try:
+        with os.fdopen(handle, 'wb') as tmp_file:
+            write(tmp_file)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def overlap_region(target_shape, source_shape, position):
+    """Calculates the region where a source (centered at position) overlaps with a target, see embed_in_image.
+
+    :param target_shape: shape of the target
+    :param source_shape: shape of the source
+    :param position: position (x,y) of the center of the source in the target
+    :return: tuple of slices (target region, source region), or None if they do not overlap
+    """
+    pos_source_start = np.subtract(position, np.floor_divide(source_shape[0:2], 2))
+    pos_target_start = np.maximum(pos_source_start, 0)
+    pos_target_end = np.minimum(np.add(pos_source_start, source_shape[0:2]), target_shape[0:2])
+    if np.any(pos_target_end <= pos_target_start):
+        return None
+    source_start = pos_target_start - pos_source_start
+    source_end = pos_target_end - pos_source_start
+    return ((slice(pos_target_start[0], pos_target_end[0]), slice(pos_target_start[1], pos_target_end[1])),
+            (slice(source_start[0], source_end[0]), slice(source_start[1], source_end[1])))
+
+
+# artefacts with less than this fraction of nonzero pixels (in their bounding box) are kept as SparseArtefact
+SPARSE_DENSITY = .25
+
+
+class SparseArtefact:
+    """An artefact (or its footprint) stored as its nonzero pixels only: their (row, column) coordinates within
+    the bounding box of the artefact and their values. Rotated thin artefacts (e.g. rulers) cover a small part of
+    their bounding box only, embedding them this way (see embed_in_image_inplace) takes time proportional to the
+    pixels they change.
+    """
+
+    def __init__(self, shape, rows, cols, values=None):
+        """
+        :param shape: shape of the dense artefact
+        :param rows: 1d integer ndarray of row coordinates
+        :param cols: 1d integer ndarray of column coordinates
+        :param values: ndarray (N, channels) of the values of the pixels, or None for a footprint
+        """
+        self.shape = tuple(shape)
+        self.rows = rows
+        self.cols = cols
+        self.values = values
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + self.cols.nbytes + (self.values.nbytes if self.values is not None else 0)
+
+    def setflags(self, write=None):
+        for array in (self.rows, self.cols, self.values):
+            if array is not None:
+                array.setflags(write=write)
+
+    def target_coordinates(self, position, target_shape):
+        """Coordinates of the pixels in a target, if the artefact is centered at position (see embed_in_image).
+
+        :param position: position (x,y) of the center of the artefact in the target
+        :param target_shape: shape of the target
+        :return: (rows, cols, inside) tuple, coordinates of the pixels within the target and a boolean ndarray
+            selecting those pixels (None if all pixels lie within the target)
+        """
+        rows = self.rows + (int(position[0]) - self.shape[0] // 2)
+        cols = self.cols + (int(position[1]) - self.shape[1] // 2)
+        if len(rows) and rows.min() >= 0 and cols.min() >= 0 and rows.max() < target_shape[0] and \
+                cols.max() < target_shape[1]:
+            return rows, cols, None
+        inside = (rows >= 0) & (rows < target_shape[0]) & (cols >= 0) & (cols < target_shape[1])
+        return rows[inside], cols[inside], inside
+
+
+def compact_artefact(artefact, max_density=SPARSE_DENSITY):
+    """Provides the artefact as SparseArtefact if at most max_density of its pixels are nonzero.
+
+    :param artefact: ndarray (H, W, channels)
+    :param max_density: fraction of nonzero pixels
+    :return: SparseArtefact, or the given artefact
+    """
+    nonzero = artefact[:, :, 0] != 0
+    for channel in range(1, artefact.shape[2]):
+        nonzero |= artefact[:, :, channel] != 0
+    index = np.flatnonzero(nonzero)
+    if len(index) > max_density * nonzero.size:
+        return artefact
+    rows, cols = np.divmod(index, artefact.shape[1])
+    return SparseArtefact(artefact.shape, rows, cols, artefact[rows, cols])
+
+
+def artefact_footprint(artefact):
+    """Pixels of an artefact that change an image once embedded.
+
+    :param artefact: ndarray or SparseArtefact
+    :return: 2d boolean ndarray, or a SparseArtefact without values for a SparseArtefact
+    """
+    if isinstance(artefact, SparseArtefact):
+        changed = np.any(np.abs(artefact.values) >= 1, axis=1)
+        return SparseArtefact(artefact.shape[0:2], artefact.rows[changed], artefact.cols[changed])
+    return np.any(np.abs(artefact) >= 1, axis=2)
+
+
+# spline order of the interpolation of each warp mode, see warp_artefact
+WARP_ORDERS = {'linear': 1, 'nearest': 0}
+
+
+def warp_artefact(artefact, flip=None, scale=None, angle=None, resolution_scale=None, mode='linear'):
+    """Flips (along axis flip), resizes (by factor scale), rotates (counter-clockwise by angle degrees) and finally
+    resizes the artefact by the (row, column) factors of resolution_scale in a single interpolation. All
+    transformations are combined into one affine matrix, the output is just large enough to hold the transformed
+    artefact (as with rotate(resize=True)) and the artefact is only smoothed (to avoid aliasing) along the axes it is
+    shrunk in. Compared to applying the transformations one after the other, only one float32 intermediate is
+    created.
+
+    :param artefact: ndarray (H, W, channels)
+    :param flip: axis to flip or None
+    :param scale: factor of the resize or None
+    :param angle: angle of the rotation in degrees or None
+    :param resolution_scale: (row, column) factors of the final resize or None
+    :param mode: interpolation, one of WARP_ORDERS
+    :return: float32 ndarray (H', W', channels)
+    """
+    if mode not in WARP_ORDERS:
+        raise ValueError(f"unknown warp mode '{mode}'.")
+    shape = np.array(artefact.shape[0:2])
+
+    # forward transformation of (row, column) coordinates relative to the center of the artefact, the shape of the
+    # output and the position of the center in it are adapted as resize and rotate(resize=True) would do
+    matrix = np.eye(2)
+    if flip is not None:
+        matrix[flip, flip] = -1
+    output_shape, center = shape, (shape - 1) / 2
+    if scale is not None:
+        output_shape = np.maximum(np.floor(shape * scale), 1)
+        matrix = np.diag(output_shape / shape) @ matrix
+        center = (output_shape - 1) / 2
+    if angle is not None:
+        sin, cos = np.sin(np.deg2rad(angle)), np.cos(np.deg2rad(angle))
+        rotation = np.array([[cos, -sin], [sin, cos]])
+        extent = np.abs(rotation) @ (output_shape - 1)
+        matrix = rotation @ matrix
+        output_shape, center = np.round(extent + 1), extent / 2
+    if resolution_scale is not None:
+        resized = np.maximum(np.floor(output_shape * resolution_scale), 1)
+        matrix = np.diag(resized / output_shape) @ matrix
+        center = (center + .5) * resized / output_shape - .5
+        output_shape = resized
+    output_shape = tuple(int(n) for n in output_shape)
+
+    result = artefact.astype(np.float32)
+    # the factor an input axis is stretched by is the length of the corresponding column of the matrix
+    sigma = np.maximum((1 / np.linalg.norm(matrix, axis=0) - 1) / 2, 0)
+    if sigma.any():
+        ndimage.gaussian_filter(result, sigma=(*sigma, 0), mode='constant', output=result)
+
+    inverse = np.linalg.inv(matrix)
+    offset = (shape - 1) / 2 - inverse @ center
+    warped = np.empty((artefact.shape[2], *output_shape), np.float32)
+    for channel in range(artefact.shape[2]):
+        ndimage.affine_transform(result[:, :, channel], inverse, offset, output_shape, output=warped[channel],
+                                 order=WARP_ORDERS[mode], mode='constant', cval=0, prefilter=False)
+    return warped.transpose(1, 2, 0)
+
+
+def summed_area_table(array):
+    """Provides the summed-area table (integral image) of a 2d array with a leading row and column of zeros,
+    which allows to obtain the sum of any rectangular region in constant time, see region_sum.
+
+    :param array: 2d ndarray (e.g. boolean mask)
+    :return: 2d integer ndarray of shape (rows + 1, columns + 1)
+    """
+    dtype = np.int32 if array.size < np.iinfo(np.int32).max else np.int64
+    table = np.zeros((array.shape[0] + 1, array.shape[1] + 1), dtype=dtype)
+    table[1:, 1:] = array
+    np.cumsum(table, axis=0, out=table)
+    np.cumsum(table, axis=1, out=table)
+    return table
+
+
+def region_sum(table, region):
+    """Sum of a rectangular region of the array the summed-area table was created of.
+
+    :param table: summed-area table, see summed_area_table
+    :param region: tuple of slices (rows, columns) without steps
+    :return: sum
+    """
+    rows, columns = region
+    return int(table[rows.stop, columns.stop] - table[rows.start, columns.stop]
+               - table[rows.stop, columns.start] + table[rows.start, columns.start])
+
+
+def beta_factors(image_size, a=1.5, b=1.5, cell_size=1):
+    """Provides the separable factors of the beta 'discrete' probability distribution, see `beta_distribution`.
+    The 2d distribution is the outer product of the returned row and column factors, which is why only those
+    are stored. Results are cached module wide (keyed by image height/width, a, b and cell size) and shared by
+    all callers, therefore the returned arrays are read-only.
+
+    :param image_size: tuple of image dimensions (only the first two are used)
+    :param a:
+    :param b:
+    :param cell_size: if > 1 the factors describe a coarse grid, each entry holds the sum of cell_size pixels
+    :return: tuple of 1d float32 arrays (row factor, column factor)
+    """
+    return _beta_factors(int(image_size[0]), int(image_size[1]), float(a), float(b), int(cell_size))
+
+
+@lru_cache(maxsize=128)
+def _beta_factors(height, width, a, b, cell_size):
+    normalize_const = (gamma(a) * gamma(b)) / gamma(a + b)
+
+    factors = []
+    for n in (height, width):
+        x = np.linspace(0, 1, n, dtype=np.float32)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distribution = (x ** (a - 1) * (1 - x) ** (b - 1)) / np.float32(normalize_const)
+        distribution[~np.isfinite(distribution)] = 0  # for caution
+        if cell_size > 1:
+            distribution = np.add.reduceat(distribution, np.arange(0, n, cell_size), dtype=np.float32)
+        distribution.setflags(write=False)  # shared by all callers
+        factors.append(distribution)
 
-    # calculate overlap top left and adjust image source
-    pos_target_start = np.subtract(position, np.floor_divide(image_source.shape[0:2], 2))
-    image_source = image_source[
-                   0 if pos_target_start[0] >= 0 else pos_target_start[0] * -1: image_source.shape[0],
-                   0 if pos_target_start[1] >= 0 else pos_target_start[1] * -1: image_source.shape[1]
-                   ]
-    pos_target_start = [x if x >= 0 else 0 for x in pos_target_start]
+    return tuple(factors)
 
-    # calculate overlap bottom right and adjust
-    pos_target_end = np.add(pos_target_start, image_source.shape[0:2])
-    image_source = image_source[
-                   0: image_source.shape[0]
-                   if pos_target_end[0] < image_target.shape[0]
-                   else image_source.shape[0] - (pos_target_end[0] - image_target.shape[0]),
-                   0: image_source.shape[1]
-                   if pos_target_end[1] < image_target.shape[1]
-                   else image_source.shape[1] - (pos_target_end[1] - image_target.shape[1])
-                   ]
-    pos_target_end = [x if x <= image_target.shape[i] else image_target.shape[i] for i, x in enumerate(pos_target_end)]
 
-    # paste image and deal with datatype min and max values (cut em off)
-    image_return = (image_target.copy()).astype(image_source.dtype)
-    image_return[pos_target_start[0]:pos_target_end[0], pos_target_start[1]:pos_target_end[1]] += image_source
-    image_return[image_return > (np.iinfo(image_target.dtype)).max] = (np.iinfo(image_target.dtype)).max
-    image_return[image_return < (np.iinfo(image_target.dtype)).min] = (np.iinfo(image_target.dtype)).min
-    image_return = image_return.astype(image_target.dtype)
+def grid_shape(image_size, cell_size=1):
+    """Shape of the coarse grid with cells of cell_size x cell_size pixels covering an image (partial cells at
+    the bottom and right border count as whole cells).
+
+    :param image_size: tuple of image dimensions
+    :param cell_size:
+    :return: tuple (rows, columns)
+    """
+    return -(-image_size[0] // cell_size), -(-image_size[1] // cell_size)
+
+
+def block_mean(array, cell_size):
+    """Downsamples a 2d array to the grid of `grid_shape` by averaging each cell.
+
+    :param array: 2d ndarray
+    :param cell_size:
+    :return: 2d float32 ndarray
+    """
+    if cell_size == 1:
+        return array.astype(np.float32)
 
-    return image_return
+    pad = [(0, -n % cell_size) for n in array.shape[0:2]]
+    if any(p for _, p in pad):
+        array = np.pad(array, pad, mode='edge')  # partial cells are averaged over their present pixels
+    rows, columns = array.shape[0] // cell_size, array.shape[1] // cell_size
+    return array.reshape(rows, cell_size, columns, cell_size).mean(axis=(1, 3), dtype=np.float32)
 
 
-def beta_distribution(image_size, a=1.5, b=1.5):
+def beta_distribution(image_size, a=1.5, b=1.5, cell_size=1):
     """Provides the beta 'discrete' probability distribution,
     used to initialize the random generator and to draw random values from.
     see https://en.wikipedia.org/wiki/Beta_distribution
@@ -62,40 +388,189 @@ def beta_distribution(image_size, a=1.5, b=1.5):
     :param image_size: tuple of image dimensions
     :param a:
     :param b:
+    :param cell_size: if > 1 the distribution is given on a coarse grid, see `grid_shape`
     :return: the beta continuous probability distribution as np matrix
     """
 
-    normalize_const = (gamma(a) * gamma(b)) / gamma(a + b)
+    horizontal_distribution, vertical_distribution = beta_factors(image_size, a, b, cell_size)
+    return np.outer(horizontal_distribution, vertical_distribution)  # same as transposing one and multiply with other
+
+
+def blur_mask(mask, sigma, backend='exact'):
+    """Smooths a 2d (uint8) mask with a gaussian filter, or an approximation thereof. The result is used as
+    placement weight only, so the approximations trade accuracy (see BLUR_ERROR_BOUNDS) for speed:
+
+    - 'exact': scipy.ndimage.gaussian_filter
+    - 'pyramid': the mask is averaged to a coarser resolution, blurred there and linearly interpolated back
+    - 'box': three passes of a running box filter per axis, its cost does not depend on sigma
+
+    :param mask: 2d ndarray
+    :param sigma: standard deviation of the gaussian filter
+    :param backend: one of BLUR_ERROR_BOUNDS
+    :return: smoothed mask with the dtype of the given mask
+    """
+    if backend not in BLUR_ERROR_BOUNDS:
+        raise ValueError(f"unknown blur backend '{backend}'.")
+
+    if backend == 'pyramid' and sigma >= 8:
+        factor = int(sigma / 4)  # keep a sigma of at least 4 (pixels) on the reduced resolution
+        # mirror the border at full resolution (as gaussian_filter does), so cells never straddle the border
+        margin = int(np.ceil(4 * sigma / factor)) * factor
+        pad = [(margin, margin + (-n % factor)) for n in mask.shape[0:2]]
+        blurred = block_mean(np.pad(mask, pad, mode='symmetric'), factor)
+        # averaging the cells already smooths by a variance of (factor^2 - 1) / 12 (pixels)
+        blurred = ndimage.gaussian_filter(blurred, sigma=np.sqrt(sigma ** 2 - (factor ** 2 - 1) / 12) / factor)
+        blurred = _upsample_linear(blurred, factor, (margin, margin), mask.shape[0:2])
+    elif backend == 'box' and sigma >= 2:
+        # three box filters of two different widths approximate a gaussian of the given sigma,
+        # see http://www.peterkovesi.com/papers/FastGaussianSmoothing.pdf
+        passes = 3
+        width = int(np.sqrt(12 * sigma ** 2 / passes + 1))
+        width -= 1 - width % 2  # odd widths keep the filter centered
+        narrow_passes = round((12 * sigma ** 2 - passes * width ** 2 - 4 * passes * width - 3 * passes) /
+                              (-4 * width - 4))
+        blurred = mask.astype(np.float32)
+        for axis in (0, 1):
+            for i in range(passes):
+                ndimage.uniform_filter1d(blurred, width if i < narrow_passes else width + 2, axis=axis,
+                                         output=blurred, mode='reflect')
+    else:  # exact, also used for small sigmas, where the approximations do not pay off
+        return ndimage.gaussian_filter(mask, sigma=sigma)
 
-    horizontal = np.linspace(0, 1, image_size[0], dtype=np.float16)
-    horizontal_distribution = np.array([(x ** (a - 1) * (1 - x) ** (b - 1)) / normalize_const
-                                        for x in horizontal], dtype=np.float16)
+    if np.issubdtype(mask.dtype, np.integer):
+        return np.rint(blurred).astype(mask.dtype)
+    return blurred.astype(mask.dtype)
 
-    vertical = np.linspace(0, 1, image_size[1], dtype=np.float16)
-    vertical_distribution = np.array([(x ** (a - 1) * (1 - x) ** (b - 1)) / normalize_const
-                                      for x in vertical], dtype=np.float16)
 
-    bdpd = np.outer(horizontal_distribution, vertical_distribution)  # same as transposing one and multiply with other
-    bdpd[~np.isfinite(bdpd)] = 0  # for caution
+def _upsample_linear(array, factor, start, shape):
+    """Linear interpolation of a 2d array to factor times its resolution (cells centered on the pixels they
+    cover), only the region of the given shape starting at the pixel start is computed.
+    """
+    for axis in (0, 1):
+        centers = (np.arange(start[axis], start[axis] + shape[axis]) + .5) / factor - .5
+        centers = np.clip(centers, 0, array.shape[axis] - 1)
+        lower = np.minimum(centers.astype(int), array.shape[axis] - 2)
+        weight = (centers - lower).astype(np.float32)
+        weight = weight[:, None] if axis == 0 else weight
+        array = np.take(array, lower, axis=axis) * (1 - weight) + np.take(array, lower + 1, axis=axis) * weight
+    return array
+
 
-    return bdpd
+# maximal absolute difference between the result of blur_mask with the given backend and 'exact',
+# for masks with values in [0, 255] (e.g. binary lesion masks)
+BLUR_ERROR_BOUNDS = {'exact': 0,
+                     'pyramid': 4,
+                     'box': 12}
 
 
 class Sampler:
     """Provides functionality for sampling random variables from a discrete finite 2d array.
     used to generate random x,y coordinates.
     see: https://stackoverflow.com/a/31675310
+
+    If cell_size is > 1, the array holds the probability of coarse cells (see `grid_shape`), a cell is drawn
+    first and then a uniformly distributed pixel within it. This way the cumulative distribution of the full
+    resolution image never has to be built.
     """
 
-    def __init__(self, dnf, seed=None):
+    def __init__(self, dnf, seed=None, cell_size=1, shape=None):
         self.shape = dnf.shape  # save original shape of discrete probability density "function"
+        self.image_shape = tuple(shape[0:2]) if shape is not None else (dnf.shape[0] * cell_size,
+                                                                         dnf.shape[1] * cell_size)
+        self.cell_size = cell_size
         dnf[~np.isfinite(dnf)] = 0  # compensate precision problems = hack
-        self._cdf_flat = np.cumsum(dnf.astype(np.float))  # cumulative (1d) array of probability distribution
-        self._cdf_flat = self._cdf_flat / self._cdf_flat.max()  # normalized cumulative distribution "function"
+        self._cdf_flat = np.cumsum(dnf, dtype=np.float64)  # cumulative (1d) array of probability distribution
+        self._cdf_flat /= self._cdf_flat.max()  # normalized cumulative distribution "function"
         self._rand = random.Random(seed)
 
+    def with_seed(self, seed=None):
+        """Returns a sampler sharing the (read-only) distribution of this one, but with its own random generator.
+
+        :param seed:
+        :return: Sampler
+        """
+        sampler = copy(self)
+        sampler._rand = random.Random(seed)
+        return sampler
+
     def rand2d(self):
-        index = np.argmax(self._cdf_flat > self._rand.random())
-        r = int(index / self.shape[1])
-        c = (index - r * self.shape[1])
-        return r, c
+        r, c = self.rand2d_batch(1)[0]
+        return int(r), int(c)
+
+    def rand2d_batch(self, k):
+        """Draws k random positions at once, the result equals k consecutive calls of rand2d.
+
+        :param k: number of positions to draw
+        :return: ndarray of shape (k, 2) holding (row, column) positions
+        """
+        draws = 1 if self.cell_size == 1 else 3  # cell, and sub-pixel offset in both directions
+        r = np.fromiter((self._rand.random() for _ in range(k * draws)), dtype=np.float64, count=k * draws)
+        r = r.reshape(k, draws)
+
+        index = np.searchsorted(self._cdf_flat, r[:, 0], side='right')  # first entry of the cdf greater than r
+        index = np.minimum(index, self._cdf_flat.size - 1)
+        pos = np.stack(np.divmod(index, self.shape[1]), axis=1)
+        if self.cell_size == 1:
+            return pos
+
+        pos *= self.cell_size
+        extent = np.minimum(self.cell_size, np.subtract(self.image_shape, pos))  # partial cells at the border
+        return pos + (r[:, 1:] * extent).astype(pos.dtype)
+
+
+class VariantBank:
+    """Memory bounded least recently used cache of transformed (flipped, resized, rotated) artefact templates.
+    Scaling factors and rotation angles are quantized to the given steps, so the number of variants is finite
+    and repeated transformations become lookups.
+    """
+
+    def __init__(self, max_bytes=64 * 2 ** 20, scale_step=.05, angle_step=5):
+        """
+        :param max_bytes: upper bound of memory held by cached variants, least recently used ones are evicted
+        :param scale_step: scaling factors are rounded to multiples of this value
+        :param angle_step: rotation angles (in degrees) are rounded to multiples of this value
+        """
+        self.max_bytes = max_bytes
+        self.scale_step = scale_step
+        self.angle_step = angle_step
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._variants = OrderedDict()
+
+    def __len__(self):
+        return len(self._variants)
+
+    def __contains__(self, key):
+        return key in self._variants
+
+    def quantize_scale(self, scale):
+        return max(self.scale_step, round(round(scale / self.scale_step) * self.scale_step, 6))
+
+    def quantize_angle(self, angle):
+        return int(round(angle / self.angle_step) * self.angle_step)
+
+    def get(self, key, build):
+        """Returns the variant stored for key, calls build() to obtain it if it is not cached yet.
+        Variants are shared and therefore read-only.
+
+        :param key: any hashable
+        :param build: function creating the variant
+        :return: ndarray
+        """
+        variant = self._variants.get(key)
+        if variant is not None:
+            self._variants.move_to_end(key)
+            self.hits += 1
+            return variant
+
+        self.misses += 1
+        variant = build()
+        variant.setflags(write=False)
+        if variant.nbytes <= self.max_bytes:
+            self._variants[key] = variant
+            self.nbytes += variant.nbytes
+            while self.nbytes > self.max_bytes:  # evict least recently used variants
+                _, evicted = self._variants.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        return variant
@@ -0,0 +1,239 @@
+import json
+import os
+import random
+import re
+from os import path
+
+import numpy as np
+from PIL import Image
+
+from .common import atomic_write, derive_seed
+from .generation import image_id
+from .repository import ArtefactsRepository
+from .templates import IMAGE_EXTENSIONS
+from .types import Bubble, Marking, Ruler
+
+
+def scan_files(folder, extensions=IMAGE_EXTENSIONS):
+    """Walks through the folder and its sub folders (in sorted order) and yields all files with one of the given
+    extensions together with every folder visited.
+
+    :param folder: folder to scan
+    :param extensions: list of file extensions (e.g. '.png')
+    :return: iterator over ('file', path) and ('folder', path) tuples
+    """
+    yield 'folder', folder
+    with os.scandir(folder) as entries:
+        entries = sorted(entries, key=lambda e: e.name)
+    for entry in entries:
+        if entry.is_dir():
+            yield from scan_files(entry.path, extensions)
+        elif path.splitext(entry.name)[1] in extensions:
+            yield 'file', entry.path
+
+
+def mask_pattern(pattern):
+    """Compiles a pattern of mask file names, the first * stands for the image id and further ones for any text,
+    e.g. '*_segmentation.png' matches the mask 'ISIC_0024311_segmentation.png' of the image 'ISIC_0024311.jpg'.
+
+    :param pattern: pattern of the mask file names
+    :return: compiled regular expression, its first group is the image id
+    """
+    if '*' not in pattern:
+        raise ValueError(f"mask pattern {pattern} does not contain the image id (*).")
+    first, after_id, *rest = pattern.split('*')
+    return re.compile(re.escape(first) + '(.+)' + re.escape(after_id) +
+                      ''.join('.*' + re.escape(part) for part in rest) + '$')
+
+
+class DatasetIndex:
+    """Index of the images of a dataset and their masks. Images are identified by their file name without extension
+    (see `image_id`), masks are matched to images by the id found in their file name using the given mask patterns,
+    so matching takes linear time.
+
+    If a cache file is given, the index is stored there and reused as long as no folder of the images or masks
+    changed (files added, removed or renamed) and the settings are the same.
+    """
+
+    def __init__(self, images_dir, masks_dir=None, mask_patterns=('*.*', '*_segmentation.*'),
+                 extensions=IMAGE_EXTENSIONS, cache_path=None):
+        """
+        :param images_dir: folder of the images (sub folders are included)
+        :param masks_dir: folder of the masks (sub folders are included) or None
+        :param mask_patterns: patterns of mask file names (see `mask_pattern`), if a mask matches one image
+            with several patterns the first pattern is used
+        :param extensions: extensions of image and mask files
+        :param cache_path: optional location of a json file the index is cached in
+        """
+        self.images_dir = images_dir
+        self.masks_dir = masks_dir
+        self._settings = {'images_dir': path.abspath(images_dir),
+                          'masks_dir': path.abspath(masks_dir) if masks_dir is not None else None,
+                          'mask_patterns': list(mask_patterns), 'extensions': list(extensions)}
+
+        cached = self._read_cache(cache_path) if cache_path is not None else None
+        if cached is not None:
+            self.images, self.masks = cached['images'], cached['masks']
+            return
+
+        folders = {}
+        self.images = {}
+        for kind, file in scan_files(images_dir, extensions):
+            if kind == 'folder':
+                folders[file] = os.stat(file).st_mtime_ns
+            else:
+                self.images.setdefault(image_id(file), file)  # ids have to be unique, the first image is used
+
+        self.masks = {}
+        if masks_dir is not None:
+            patterns = [mask_pattern(p) for p in mask_patterns]
+            priorities = {}
+            for kind, file in scan_files(masks_dir, extensions):
+                if kind == 'folder':
+                    folders[file] = os.stat(file).st_mtime_ns
+                    continue
+                for priority, pattern in enumerate(patterns):
+                    match = pattern.match(path.basename(file))
+                    if match and match.group(1) in self.images and \
+                            priorities.get(match.group(1), len(patterns)) > priority:
+                        self.masks[match.group(1)] = file
+                        priorities[match.group(1)] = priority
+
+        if cache_path is not None:
+            cache = {'settings': self._settings, 'folders': folders, 'images': self.images, 'masks': self.masks}
+            atomic_write(cache_path, lambda f: f.write(json.dumps(cache).encode()))
+
+    def __len__(self):
+        return len(self.images)
+
+    def __iter__(self):
+        """Iterates over the image ids in sorted order."""
+        return iter(sorted(self.images))
+
+    def __getitem__(self, identifier):
+        """Provides the image and mask (or None) of the image with the given id.
+
+        :param identifier: image id
+        :return: (image path, mask path or None) tuple
+        """
+        return self.images[identifier], self.masks.get(identifier)
+
+    def pairs(self):
+        """Provides all images and their masks, sorted by image id.
+
+        :return: list of (image path, mask path or None) tuples
+        """
+        return [self[identifier] for identifier in self]
+
+    def _read_cache(self, cache_path):
+        try:
+            with open(cache_path) as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+        if cache.get('settings') != self._settings:
+            return None
+        for folder, mtime in cache['folders'].items():
+            try:
+                if os.stat(folder).st_mtime_ns != mtime:
+                    return None
+            except OSError:
+                return None
+        return cache
+
+
+def worker_shard():
+    """Provides the shard of the current data loader worker, if torch is installed and this is a worker process of
+    a torch DataLoader, otherwise the only shard.
+
+    :return: (shard index, number of shards) tuple
+    """
+    try:
+        from torch.utils.data import get_worker_info
+    except ImportError:
+        return 0, 1
+    info = get_worker_info()
+    return (0, 1) if info is None else (info.id, info.num_workers)
+
+
+class AugmentationStream:
+    """Iterable inserting artefacts into the images of a dataset on the fly, e.g. as online augmentation for
+    training, without writing images to disk. It does not depend on any framework, but can be wrapped in (or used
+    as) an iterable dataset of a data loader.
+
+    The randomness of every sample (whether and which artefact is inserted and how) is derived from the root seed,
+    the epoch and the image id only. Results therefore neither depend on the order of images nor on the number of
+    shards or workers they are split into. Each worker iterates over its own shard and creates its own (lazy)
+    ArtefactsRepository on first use.
+    """
+
+    def __init__(self, source, meta_path, artefact_classes=(Bubble, Marking, Ruler), probability=1., root_seed=0,
+                 shuffle=False, shard=None, return_type='ndarray', repository_kwargs=None):
+        """
+        :param source: DatasetIndex or sequence of (image path, mask path or None) tuples
+        :param meta_path: location of the meta.json file describing the artefacts
+        :param artefact_classes: artefact classes, one of them is selected randomly for every sample
+        :param probability: probability of inserting an artefact into a sample
+        :param root_seed: seed of the stream
+        :param shuffle: if True, the order of samples is shuffled in every epoch (see set_epoch)
+        :param shard: (shard index, number of shards) tuple, determined by `worker_shard` if None
+        :param return_type: 'ndarray' to obtain images and masks as uint8 ndarrays, 'image' for PIL Images
+        :param repository_kwargs: further arguments of the ArtefactsRepository (e.g. template_cache)
+        """
+        if return_type not in ('image', 'ndarray'):
+            raise ValueError(f"unknown return type '{return_type}'.")
+        self.pairs = source.pairs() if isinstance(source, DatasetIndex) else list(source)
+        self.meta_path = meta_path
+        self.artefact_classes = list(artefact_classes)
+        self.probability = probability
+        self.root_seed = root_seed
+        self.shuffle = shuffle
+        self.shard = shard
+        self.return_type = return_type
+        self.epoch = 0
+        self._repository_kwargs = {'lazy': True, **(repository_kwargs or {})}
+        self._repository = None
+
+    def set_epoch(self, epoch):
+        """Sets the epoch, which changes the randomness (and order, if shuffled) of all samples.
+
+        :param epoch: number of the epoch
+        """
+        self.epoch = epoch
+
+    def _shard_pairs(self):
+        pairs = self.pairs
+        if self.shuffle:
+            pairs = list(pairs)
+            random.Random(derive_seed(self.root_seed, self.epoch)).shuffle(pairs)
+        index, count = self.shard if self.shard is not None else worker_shard()
+        return pairs[index::count]
+
+    def __len__(self):
+        return len(self._shard_pairs())
+
+    def __iter__(self):
+        """Yields (image, mask, artefact_meta) tuples for the pairs of the current shard. The mask is None if the
+        pair has none, artefact_meta describes the inserted artefact (see Artefact.last_insertion, extended by the
+        id of the image and the seed used) or is None if no artefact was inserted.
+        """
+        if self._repository is None:
+            self._repository = ArtefactsRepository(self.meta_path, **self._repository_kwargs)
+
+        for image_path, mask_path in self._shard_pairs():
+            identifier = image_id(image_path)
+            seed = derive_seed(self.root_seed, self.epoch, identifier)
+            rand = random.Random(seed)
+
+            image = np.asarray(Image.open(image_path))
+            mask = np.asarray(Image.open(mask_path)) if mask_path else None
+            meta = None
+            if rand.random() < self.probability:
+                artefact = self._repository.get_random_instance(rand.choice(self.artefact_classes), seed=seed)
+                image = artefact(image, mask, return_type='ndarray')
+                meta = {'id': identifier, 'seed': seed, **artefact.last_insertion}
+
+            if self.return_type == 'image':
+                image = Image.fromarray(image)
+                mask = Image.fromarray(mask) if mask is not None else None
+            yield image, mask, meta
@@ -0,0 +1,320 @@
+import hashlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from os.path import join
+from shutil import copy2
+
+from PIL import Image
+
+from .common import derive_seed
+from .repository import ArtefactsRepository
+from .templates import template_sources_key
+from .writers import PngWriter
+
+# repository of the current worker process, see _init_worker
+_repository = None
+
+
+def _init_worker(meta_path, repository_kwargs):
+    """Creates the ArtefactsRepository once per worker process."""
+    global _repository
+    _repository = ArtefactsRepository(meta_path, **{'lazy': True, **repository_kwargs})
+
+
+def image_id(image_path):
+    """Identifier of an image used to derive its seeds, the file name without extension."""
+    return os.path.splitext(os.path.basename(image_path))[0]
+
+
+def insert_artefacts(repository, image, mask, identifier, artefact_classes, root_seed=0):
+    """Applies one artefact of each of the given classes to the image (each one separately). The artefact used and
+    its randomness only depend on the root seed, the image identifier and the name of the class.
+
+    :param repository: ArtefactsRepository
+    :param image: PIL Image
+    :param mask: mask or None
+    :param identifier: identifier of the image
+    :param artefact_classes: list of (name, artefact class) tuples
+    :param root_seed: seed of the whole dataset
+    :return: list of (name, PIL Image, insertion) tuples, insertion describes the inserted artefacts (see
+        Artefact.last_insertion) and the seed used
+    """
+    context = None  # blurred mask and samplers are shared by all artefacts of this image
+    results = []
+    for name, artefact_class in artefact_classes:
+        seed = derive_seed(root_seed, identifier, name)
+        artefact = repository.get_random_instance(artefact_class, seed=seed)
+        if context is None:  # created with the settings of the artefacts (e.g. blur, sampling_cell)
+            context = artefact._placement_context(image, mask)
+        results.append((name, artefact(image, context), {'seed': seed, **artefact.last_insertion}))
+    return results
+
+
+def source_fingerprint(pair, contents=None):
+    """Describes the state of the source files (image and mask) of a pair: size and modification time of each file
+    and a hash of their content.
+
+    :param pair: (image path, mask path or None, target folder) tuple
+    :param contents: content of the source files if already read, they are read otherwise
+    :return: dict
+    """
+    files = [f for f in pair[0:2] if f]
+    if contents is None:
+        contents = []
+        for f in files:
+            with open(f, 'rb') as source_file:
+                contents.append(source_file.read())
+    digest = hashlib.sha256()
+    for content in contents:
+        digest.update(hashlib.sha256(content).digest())
+    stats = [os.stat(f) for f in files]
+    return {'hash': digest.hexdigest(), 'stat': [[stat.st_size, stat.st_mtime_ns] for stat in stats]}
+
+
+def settings_fingerprint(meta_path, repository_kwargs=None, writer=None):
+    """Hash identifying the settings images are generated with: the artefacts and their templates (see
+    template_sources_key), the settings of the ArtefactsRepository (e.g. blur, sampling_cell, warp) and the writer.
+    The location of the template cache is not included, it does not change the generated images.
+
+    :param meta_path: location of the meta.json file describing the artefacts
+    :param repository_kwargs: further arguments of the ArtefactsRepository
+    :param writer: writer the images are stored with, see `writers`
+    :return: hex digest
+    """
+    with open(meta_path) as meta_file:
+        entries = json.load(meta_file)['artefacts']
+    settings = {'templates': template_sources_key(meta_path, entries),
+                'repository': {k: v for k, v in (repository_kwargs or {}).items() if k != 'template_cache'},
+                'writer': [type(writer).__name__, vars(writer)] if writer is not None else None}
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=repr).encode()).hexdigest()
+
+
+class Manifest:
+    """Records every generated image in a JSON lines file: its source files (see source_fingerprint), the settings
+    it was generated with (see settings_fingerprint), the seed and the artefacts inserted. Lines are appended as soon as images are written, so the manifest survives interrupted
+    runs and is used to skip images which are complete and up to date when generating a dataset again.
+    """
+
+    def __init__(self, manifest_path):
+        """
+        :param manifest_path: location of the manifest file, it is created if missing
+        """
+        self.manifest_path = manifest_path
+        self.records = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                for line in manifest_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:  # e.g. the last line of an interrupted run
+                        continue
+                    self.records[record['output']] = record  # later records replace earlier ones
+
+    def add(self, records):
+        """Appends the given records to the manifest file.
+
+        :param records: list of dicts, each one with the path of the generated image as 'output'
+        """
+        with open(self.manifest_path, 'a') as manifest_file:
+            for record in records:
+                manifest_file.write(json.dumps(record) + '\n')
+                self.records[record['output']] = record
+
+    def is_complete(self, pair, artefact_classes, root_seed, settings=None):
+        """Tests if all images of a pair exist and were generated from the current source files with the given
+        settings and the seeds derived from root_seed. The content of the source files is only hashed if their size or modification time
+        differs from the recorded one.
+
+        :param pair: (image path, mask path or None, target folder) tuple
+        :param artefact_classes: list of (file name, artefact class) tuples
+        :param root_seed: seed of the whole dataset
+        :param settings: fingerprint of the current settings, see settings_fingerprint
+        :return: True if the pair does not need to be processed again
+        """
+        records = []
+        for name, _ in artefact_classes:
+            output = join(pair[2], name)
+            record = self.records.get(output)
+            if record is None or not os.path.exists(output) or record['mask'] != pair[1] or \
+                    record.get('settings') != settings or \
+                    record['seed'] != derive_seed(root_seed, image_id(pair[0]), name):
+                return False
+            records.append(record)
+
+        sources = [record['source'] for record in records]
+        if any(source != sources[0] for source in sources):
+            return False
+        current = [[stat.st_size, stat.st_mtime_ns] for stat in (os.stat(f) for f in pair[0:2] if f)]
+        return current == sources[0]['stat'] or source_fingerprint(pair)['hash'] == sources[0]['hash']
+
+
+def link_or_copy(source, target):
+    """Makes the file source available as target: nothing is done if target already is the same file or a copy of
+    it (same size and modification time), otherwise a hardlink is created, or a copy if linking is not possible.
+
+    :param source: path of the existing file
+    :param target: path of the new file
+    """
+    if os.path.exists(target):
+        if os.path.samefile(source, target):
+            return
+        source_stat, target_stat = os.stat(source), os.stat(target)
+        if source_stat.st_size == target_stat.st_size and source_stat.st_mtime_ns == target_stat.st_mtime_ns:
+            return
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:  # e.g. different file systems or no support for hardlinks
+        copy2(source, target)
+
+
+def staged_pipeline(items, read, compute, write, readers=2, writers=2, depth=8):
+    """Streams items through three stages: read (by a pool of reader threads, ahead of time), compute (in the
+    calling thread, in the order of items) and write (by a pool of writer threads). Decoding and encoding images
+    thereby overlap with computation, while at most depth items are held in each of the stages.
+
+    :param items: iterable of items
+    :param read: function item -> read result, called by reader threads
+    :param compute: function read result -> compute result
+    :param write: function compute result -> write result, called by writer threads
+    :param readers: number of reader threads
+    :param writers: number of writer threads
+    :param depth: maximum number of items read ahead and waiting to be written
+    :return: iterator over the write results, in the order of items
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(readers) as reader_pool, ThreadPoolExecutor(writers) as writer_pool:
+        reading, writing = deque(), deque()
+
+        def read_ahead():
+            for item in itertools.islice(items, depth - len(reading)):
+                reading.append(reader_pool.submit(read, item))
+
+        read_ahead()
+        while reading:
+            result = compute(reading.popleft().result())
+            read_ahead()
+            writing.append(writer_pool.submit(write, result))
+            while len(writing) > depth or (writing and writing[0].done()):
+                yield writing.popleft().result()
+        while writing:
+            yield writing.popleft().result()
+
+
+def _read_pair(pair):
+    """Reads and decodes the image and mask of a pair, the content read is fingerprinted on the way."""
+    contents = []
+    for f in pair[0:2]:
+        if f:
+            with open(f, 'rb') as source_file:
+                contents.append(source_file.read())
+    image = Image.open(io.BytesIO(contents[0]))
+    image.load()
+    mask = None
+    if pair[1]:
+        mask = Image.open(io.BytesIO(contents[1]))
+        mask.load()
+    return pair, image, mask, source_fingerprint(pair, contents), contents
+
+
+def _insert_pair(read_result, artefact_classes, root_seed):
+    """Inserts the artefacts into the image of a pair, the result describes the sample to write (see writers)."""
+    pair, image, mask, source, contents = read_result
+    identifier = image_id(pair[0])
+    return {'id': identifier, 'pair': pair, 'source': source, 'files': contents, 'image': image, 'mask': mask,
+            'results': insert_artefacts(_repository, image, mask, identifier, artefact_classes, root_seed)}
+
+
+def _write_pair(sample, writer):
+    return sample['pair'][0], writer.encode(sample)
+
+
+def _process_pairs(pairs, artefact_classes, root_seed, io_threads=2, writer=None, shard_index=0):
+    """Processes the given pairs in a staged pipeline in the current process, see staged_pipeline. The samples
+    are encoded by the writer threads and appended to the shard in the order of pairs."""
+    writer = writer if writer is not None else PngWriter()
+    compute = partial(_insert_pair, artefact_classes=artefact_classes, root_seed=root_seed)
+    write = partial(_write_pair, writer=writer)
+    with writer.shard(shard_index) as shard:
+        for image_path, encoded in staged_pipeline(pairs, _read_pair, compute, write, readers=io_threads,
+                                                   writers=io_threads):
+            yield image_path, shard.append(encoded)
+
+
+def _process_chunk(indexed_chunk, artefact_classes, root_seed, io_threads, writer):
+    shard_index, chunk = indexed_chunk
+    return list(_process_pairs(chunk, artefact_classes, root_seed, io_threads, writer, shard_index))
+
+
+def generate_dataset(pairs, meta_path, artefact_classes, root_seed=0, workers=None, chunk_size=16, io_threads=2,
+                     repository_kwargs=None, manifest_path=None, writer=None):
+    """Inserts artefacts into all given images using a pool of worker processes, each one holding its own
+    ArtefactsRepository. As the seeds are derived from the root seed and the image identifiers, the output does not
+    depend on the number of workers or the order images are processed in.
+
+    If a manifest is used, every generated image is recorded in it and images which are complete and up to date
+    (see Manifest.is_complete) are skipped, so an interrupted run can be resumed and only new or changed source
+    images are processed again. All images are generated again if the settings changed (see settings_fingerprint).
+
+    Images are stored by the given writer (see `writers`), by default as png files in the target folder of each
+    pair. Shard writers store all images of a chunk of pairs (of writer.shard_size pairs) in one shard, the chunk
+    size is ignored then.
+
+    :param pairs: list of (image path, mask path or None, target folder) tuples, the target folder is not used by
+        shard writers
+    :param meta_path: location of the meta.json file describing the artefacts
+    :param artefact_classes: list of (file name, artefact class) tuples, one image is created for each
+    :param root_seed: seed of the whole dataset
+    :param workers: number of worker processes (defaults to the number of cpus), 1 processes all images in this process
+    :param chunk_size: number of images sent to a worker at once
+    :param io_threads: number of threads decoding and (separately) encoding images in each worker, so reading and
+        writing overlaps with inserting artefacts
+    :param repository_kwargs: further arguments of the ArtefactsRepository (e.g. template_cache)
+    :param manifest_path: optional location of the manifest file (e.g. in the target directory), not supported by
+        shard writers
+    :param writer: PngWriter (default), TarShardWriter or NpyShardWriter
+    :return: iterator over the image paths of all pairs (skipped ones first), in the order they are completed
+    """
+    initargs = (meta_path, repository_kwargs or {})
+    writer = writer if writer is not None else PngWriter()
+    if writer.sharded and manifest_path is not None:
+        raise ValueError("a manifest can only be used with writers storing every image in its own file.")
+    manifest = Manifest(manifest_path) if manifest_path is not None else None
+
+    pairs = list(pairs)
+    if manifest is not None:
+        settings = settings_fingerprint(meta_path, repository_kwargs, writer)
+        complete = [manifest.is_complete(pair, artefact_classes, root_seed, settings) for pair in pairs]
+        yield from (pair[0] for pair, done in zip(pairs, complete) if done)
+        pairs = [pair for pair, done in zip(pairs, complete) if not done]
+
+    if writer.sharded:
+        chunk_size = writer.shard_size
+    chunks = list(enumerate(pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)))
+    if workers == 1:
+        _init_worker(*initargs)
+        if writer.sharded:
+            processed = itertools.chain.from_iterable(
+                _process_pairs(chunk, artefact_classes, root_seed, io_threads, writer, i) for i, chunk in chunks)
+        else:
+            processed = _process_pairs(pairs, artefact_classes, root_seed, io_threads, writer)
+    else:
+        process = partial(_process_chunk, artefact_classes=artefact_classes, root_seed=root_seed,
+                          io_threads=io_threads, writer=writer)
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=initargs)
+        processed = itertools.chain.from_iterable(pool.imap_unordered(process, chunks))
+
+    try:
+        for image_path, records in processed:
+            if manifest is not None:
+                manifest.add([{**record, 'settings': settings} for record in records])
+            yield image_path
+    finally:
+        if workers != 1:
+            pool.terminate()
@@ -0,0 +1,172 @@
+from copy import copy
+
+import numpy as np
+from PIL import Image
+from scipy import ndimage
+
+from .common import Sampler, block_mean, blur_mask, BLUR_ERROR_BOUNDS
+from .profiling import stage
+
+
+class PlacementContext:
+    """Holds everything needed to place artefacts in one image, that only depends on the image size and the
+    (lesion-)mask: the blurred mask, the inverted placement weights, the center of mass of the mask and the
+    samplers of the different placement policies of the artefact classes. All values are computed lazily on first
+    use and then cached, so applying several artefacts to the same image/mask pair pays for them only once.
+
+    A context can be passed to any Artefact in place of the mask.
+
+    If the image is a resized version of the image artefacts are meant to be inserted in (see the size argument of
+    `Artefact.__call__`), resolution_scale gives the factors it was resized by. Artefact templates and the
+    smoothing of the mask are scaled accordingly.
+
+    By default every artefact only avoids overlapping with its own artefacts. If the artefacts of several classes are
+    inserted into the same image, they can avoid each other by sharing an OccupancyIndex (see with_occupancy).
+    """
+
+    def __init__(self, image, mask=None, sampling_cell=1, sigma=15, blur='exact', resolution_scale=(1, 1)):
+        """
+        :param image: PIL Image or ndarray (only its size is used), or a tuple of image dimensions
+        :param mask: (lesion-)mask as PIL Image or ndarray, or None
+        :param sampling_cell: cell size of the sampling grid, see `Artefact`
+        :param sigma: standard deviation of the gaussian filter used to smooth the mask (at the original resolution)
+        :param blur: backend used to smooth the mask, see `blur_mask`
+        :param resolution_scale: (row, column) factors the image was resized by
+        """
+        if blur not in BLUR_ERROR_BOUNDS:
+            raise ValueError(f"unknown blur backend '{blur}'.")
+        if isinstance(image, Image.Image):
+            self.shape = (image.height, image.width)
+        else:
+            self.shape = tuple(getattr(image, 'shape', image)[0:2])
+        self.mask = np.array(mask, dtype='uint8') if mask is not None else None
+        self.sampling_cell = sampling_cell
+        self.resolution_scale = tuple(float(f) for f in resolution_scale)
+        self.sigma = sigma * np.sqrt(self.resolution_scale[0] * self.resolution_scale[1])
+        self.blur = blur
+        self.occupancy = None  # OccupancyIndex shared by all artefacts placed with this context, see with_occupancy
+        self._cache = {}
+
+    def cached(self, key, build):
+        """Returns the value stored for key, calls build(self) to obtain it if it is not known yet.
+
+        :param key: any hashable
+        :param build: function creating the value from this context
+        :return: cached value
+        """
+        if key not in self._cache:
+            self._cache[key] = build(self)
+        return self._cache[key]
+
+    def with_occupancy(self):
+        """Returns a copy of this context sharing all cached values, but holding a new OccupancyIndex shared by all
+        artefacts placed with the copy, so later artefacts avoid the regions occupied by earlier ones.
+
+        :return: PlacementContext
+        """
+        context = copy(self)
+        context.occupancy = OccupancyIndex(self.shape)
+        return context
+
+    @property
+    def blurred_mask(self):
+        """Smoothed mask in full resolution (None if no mask is given)."""
+        def build(c):
+            if c.mask is None:
+                return None
+            with stage('blur'):
+                return blur_mask(c.mask, c.sigma, c.blur)
+        return self.cached('blurred_mask', build)
+
+    @property
+    def blurred_grid(self):
+        """Smoothed mask averaged to the sampling grid (None if no mask is given)."""
+        return self.cached('blurred_grid', lambda c: None if c.mask is None else
+                           block_mean(c.blurred_mask, c.sampling_cell))
+
+    @property
+    def weights(self):
+        """Placement weights on the sampling grid, the smoothed mask normalized to [0,1] and inverted."""
+        return self.cached('weights', lambda c: None if c.mask is None else (c.blurred_grid / -255) + 1)
+
+    @property
+    def center_of_mass(self):
+        """Center of mass of the mask as integer (row, column), the center of the image if no mask is given."""
+        def build(c):
+            if c.mask is None:
+                return tuple(int(x) for x in np.divide(c.shape, 2))
+            pos = ndimage.center_of_mass(c.mask)
+            return int(pos[0]), int(pos[1])
+        return self.cached('center_of_mass', build)
+
+    def sampler(self, policy, distribution, seed=None):
+        """Provides a sampler for the given placement policy. The probability distribution is obtained
+        only once per policy by calling distribution(self), subsequent calls share it.
+
+        :param policy: name of the placement policy
+        :param distribution: function returning the discrete probability distribution on the sampling grid
+        :param seed: seed of the returned sampler
+        :return: Sampler
+        """
+        def build(c):
+            with stage('distribution'):
+                return Sampler(distribution(c), cell_size=c.sampling_cell, shape=c.shape)
+        return self.cached(('sampler', policy), build).with_seed(seed)
+
+
+class OccupancyIndex:
+    """Keeps track of the rectangular regions of an image occupied by placed artefacts. Overlap queries
+    only depend on the number of placed rectangles, not on the size of the image.
+    """
+
+    def __init__(self, shape):
+        """
+        :param shape: tuple of image dimensions, rectangles are clipped to the image
+        """
+        self.shape = tuple(shape[0:2])
+        self._rectangles = np.empty((0, 4), dtype=np.int64)  # rows of (top, left, bottom, right), end exclusive
+
+    def __len__(self):
+        return len(self._rectangles)
+
+    def _clip(self, start, end):
+        start = np.clip(start, 0, self.shape)
+        end = np.clip(end, 0, self.shape)
+        if np.any(end <= start):
+            return None  # outside of the image
+        return np.concatenate([start, end])
+
+    def overlaps(self, start, end):
+        """Tests if the rectangle from start (inclusive) to end (exclusive) overlaps with any occupied region.
+
+        :param start: (row, column) of the top left corner
+        :param end: (row, column) of the bottom right corner
+        :return: bool
+        """
+        rectangle = self._clip(start, end)
+        if rectangle is None or not len(self._rectangles):
+            return False
+        r = self._rectangles
+        return bool(np.any((r[:, 0] < rectangle[2]) & (rectangle[0] < r[:, 2]) &
+                           (r[:, 1] < rectangle[3]) & (rectangle[1] < r[:, 3])))
+
+    @staticmethod
+    def extent(artefact, pos):
+        """Rectangle covered by an artefact (or any array) centered at pos, see embed_in_image.
+
+        :param artefact: ndarray or SparseArtefact
+        :param pos: (row, column) of the center
+        :return: (start, end) tuple of the top left (inclusive) and bottom right (exclusive) corner
+        """
+        start = np.subtract(pos, np.floor_divide(artefact.shape[0:2], 2))
+        return start, np.add(start, artefact.shape[0:2])
+
+    def add(self, start, end):
+        """Marks the rectangle from start (inclusive) to end (exclusive) as occupied.
+
+        :param start: (row, column) of the top left corner
+        :param end: (row, column) of the bottom right corner
+        """
+        rectangle = self._clip(start, end)
+        if rectangle is not None:
+            self._rectangles = np.vstack([self._rectangles, rectangle])
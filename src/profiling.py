@@ -0,0 +1,153 @@
+import contextlib
+import json
+import time
+import tracemalloc
+from collections import defaultdict
+
+import numpy as np
+
+# profiler of the current process, see profile
+_profiler = None
+
+_NO_STAGE = contextlib.nullcontext()
+
+
+def stage(name, owner=None):
+    """Measures the enclosed block as stage of an artefact call, if a profiler is active. Otherwise nothing is done,
+    so instrumented code only pays for one function call.
+
+    :param name: name of the stage
+    :param owner: artefact the stage belongs to, by default the artefact of the enclosing stage
+    :return: context manager
+    """
+    if _profiler is None:
+        return _NO_STAGE
+    return _profiler.stage(name, owner)
+
+
+def count(name, n=1, owner=None):
+    """Increases a counter (e.g. of placement attempts) of the artefact class, if a profiler is active.
+
+    :param name: name of the counter
+    :param n: increment
+    :param owner: artefact the counter belongs to, by default the artefact of the enclosing stage
+    """
+    if _profiler is not None:
+        _profiler.count(name, n, owner)
+
+
+@contextlib.contextmanager
+def profile(allocations=False):
+    """Activates a Profiler in this process for the enclosed block, e.g.
+
+        with profile() as profiler:
+            artefact(image, mask)
+        profiler.to_json('profile.json')
+
+    :param allocations: if True, memory allocations are traced as well (see Profiler)
+    :return: context manager providing the Profiler
+    """
+    global _profiler
+    if _profiler is not None:
+        raise RuntimeError("a profiler is already active.")
+    profiler = Profiler(allocations)
+    if allocations:
+        tracemalloc.start()
+    _profiler = profiler
+    try:
+        yield profiler
+    finally:
+        _profiler = None
+        if allocations:
+            tracemalloc.stop()
+
+
+class Profiler:
+    """Collects the wall time of the stages of artefact calls (e.g. blurring the mask, transforming and placing
+    artefacts) and counters (e.g. placement attempts) per artefact class. Stages may be nested, the time of a stage
+    includes the time of the stages within.
+
+    If allocations are traced (using tracemalloc), the memory allocated by a stage and not freed at its end
+    ('allocated') and the peak of memory allocated during the stage ('peak') are recorded in bytes.
+    """
+
+    def __init__(self, allocations=False):
+        """
+        :param allocations: record memory allocations, tracemalloc has to be running
+        """
+        self.allocations = allocations
+        self._times = defaultdict(lambda: defaultdict(list))
+        self._memory = defaultdict(lambda: defaultdict(list))
+        self._counters = defaultdict(lambda: defaultdict(int))
+        self._owners = []  # class names of the enclosing stages
+        self._frames = []  # [start, peak] of traced memory of the enclosing stages
+
+    def _owner_name(self, owner):
+        if owner is not None:
+            return type(owner).__name__
+        return self._owners[-1] if self._owners else None
+
+    @contextlib.contextmanager
+    def stage(self, name, owner=None):
+        """Measures the enclosed block as stage name of the artefact class of owner, see `stage`."""
+        owner = self._owner_name(owner)
+        self._owners.append(owner)
+        if self.allocations:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._frames:
+                self._frames[-1][1] = max(self._frames[-1][1], peak)
+            tracemalloc.reset_peak()
+            self._frames.append([current, current])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._times[owner][name].append(time.perf_counter() - start)
+            self._owners.pop()
+            if self.allocations:
+                current, peak = tracemalloc.get_traced_memory()
+                frame = self._frames.pop()
+                frame[1] = max(frame[1], peak)
+                self._memory[owner][name].append((current - frame[0], frame[1] - frame[0]))
+                if self._frames:
+                    self._frames[-1][1] = max(self._frames[-1][1], frame[1])
+
+    def count(self, name, n=1, owner=None):
+        """Increases the counter name of the artefact class of owner by n, see `count`."""
+        self._counters[self._owner_name(owner)][name] += n
+
+    def stats(self):
+        """Aggregates all measurements per artefact class: for each stage the number of calls and the total,
+        mean, median, 90th percentile and maximum time in milliseconds (and the mean and maximum of allocated and
+        peak memory in bytes), and all counters.
+
+        :return: dict (JSON serializable)
+        """
+        stats = {}
+        for owner in sorted(set(self._times) | set(self._counters), key=str):
+            stages = {}
+            for name, times in self._times[owner].items():
+                times = np.array(times) * 1000
+                stages[name] = {'calls': len(times), 'total_ms': float(times.sum()), 'mean_ms': float(times.mean()),
+                                'p50_ms': float(np.percentile(times, 50)), 'p90_ms': float(np.percentile(times, 90)),
+                                'max_ms': float(times.max())}
+                if self.allocations:
+                    memory = np.array(self._memory[owner][name])
+                    stages[name].update({'allocated_mean': float(memory[:, 0].mean()),
+                                         'allocated_max': int(memory[:, 0].max()),
+                                         'peak_mean': float(memory[:, 1].mean()),
+                                         'peak_max': int(memory[:, 1].max())})
+            stats[str(owner)] = {'stages': stages, 'counters': dict(self._counters[owner])}
+        return stats
+
+    def to_json(self, file_path=None):
+        """Exports the aggregated stats (see stats) as JSON.
+
+        :param file_path: optional location of the file to write
+        :return: JSON string
+        """
+        result = json.dumps(self.stats(), indent=2)
+        if file_path is not None:
+            with open(file_path, 'w') as json_file:
+                json_file.write(result)
+        return result
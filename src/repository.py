@@ -1,30 +1,167 @@
 import json
 import random
 from os import path
-from src.types import Artefact, Bubble, Marking, Ruler
+
+import numpy as np
+
+from src.common import derive_seed, resize_input, to_array, to_image
+from src.profiling import stage
+from src.templates import TemplateStore
+from src.types import Artefact, Bubble, Marking, Ruler, artefact_type
 
 
 class ArtefactsRepository:
     """Manages loading and handling of artefacts. """
 
-    def __init__(self, meta_path, seed=None):
+    def __init__(self, meta_path, seed=None, template_cache=None, lazy=False, **kwargs):
+        """
+            :param meta_path: location of the meta.json file describing the artefacts
+            :param seed: seed for initialization and selection of artefacts
+            :param template_cache: optional folder of a TemplateStore holding all prepared templates in one
+                memory-mapped file, it is created if missing and rebuilt automatically if the meta.json file or any
+                artefact image changed
+            :param lazy: if True, artefact objects (and their templates) are only created once they are selected
+            :param kwargs: further settings passed to each Artefact (e.g. sampling_cell, blur)
+        """
 
-        self.artefacts = []
+        self._meta_path = meta_path
+        self._seed = seed
+        self._artefact_kwargs = kwargs
         self._rand = random.Random(seed)
         with open(meta_path) as meta_file:
-            data = json.load(meta_file)
-            for i, entry in enumerate(data['artefacts']):
-                self.artefacts.append(Artefact(entry, path.dirname(meta_path), i + seed if seed else None))
+            self._entries = json.load(meta_file)['artefacts']
+
+        # indices of the entries of each artefact class (including base classes like Marking), in order
+        self._class_index = {}
+        for i, entry in enumerate(self._entries):
+            for cls in artefact_type(entry).__mro__:
+                if issubclass(cls, Artefact):
+                    self._class_index.setdefault(cls, []).append(i)
+
+        self._store = TemplateStore(template_cache, meta_path, self._entries) if template_cache is not None else None
+        self._artefacts = [None] * len(self._entries)
+        if not lazy:
+            self.artefacts  # create all artefact objects now
+
+    @property
+    def artefacts(self):
+        """List of all artefact objects, if the repository is lazy all missing ones are created."""
+        return [self._get_artefact(i) for i in range(len(self._entries))]
 
-    def get_random_instance(self, artefact_class=None):
+    def _get_artefact(self, i):
+        """Returns the artefact object of entry i, creating it if necessary."""
+        if self._artefacts[i] is None:
+            templates = self._store.templates(i) if self._store is not None else None
+            self._artefacts[i] = Artefact(self._entries[i], path.dirname(self._meta_path),
+                                          i + self._seed if self._seed else None,
+                                          templates=templates, **self._artefact_kwargs)
+        return self._artefacts[i]
+
+    def get_random_instance(self, artefact_class=None, seed=None):
         """
             returns one of the artefact objects randomly, or randomly within given classes
-            :param artefact_class:
+            :param artefact_class: artefact class or tuple of classes to select from
+            :param seed: if given, the selection does not use the random generator of the repository but one seeded
+                with seed, and the selected artefact is reseeded with it as well; thus the selection and the result
+                of applying the artefact only depend on this seed
             :return: artefact object
         """
+        rand = self._rand if seed is None else random.Random(seed)
         if artefact_class is None:
-            artefact_class = self._rand.choice([Bubble, Marking, Ruler])
+            artefact_class = rand.choice([Bubble, Marking, Ruler])
 
-        candidates = [item for item in self.artefacts if isinstance(item, artefact_class)]
-        selected = self._rand.choice(candidates)
+        selected = self._get_artefact(rand.choice(self._candidates(artefact_class)))
+        if seed is not None:
+            selected.reseed(seed)
         return selected
+
+    def _candidates(self, artefact_class):
+        """Indices of the entries of the given class or tuple of classes (as for isinstance), in order."""
+        if isinstance(artefact_class, tuple):
+            candidates = sorted({i for cls in artefact_class for i in self._class_index.get(cls, [])})
+        else:
+            candidates = self._class_index.get(artefact_class, [])
+        if not candidates:
+            raise ValueError(f"no artefacts of class {artefact_class} in {self._meta_path}.")
+        return candidates
+
+    def compose(self, artefacts):
+        """Creates a pipeline inserting artefacts of several classes into the same image at once, see
+        ArtefactComposition.
+
+        :param artefacts: list of artefact classes (an artefact of the class is selected on each call) and artefact
+            objects, in the order they are inserted
+        :return: ArtefactComposition
+        """
+        return ArtefactComposition(self, artefacts)
+
+
+class ArtefactComposition:
+    """Inserts artefacts of several classes (e.g. a bubble, a ruler and a marking) into the same image in a single
+    pass: the image is converted once, all artefacts share one PlacementContext (the blurred mask and the sampling
+    distributions are computed once) and the result is clipped and converted once. Artefacts share the regions they
+    occupy as well, so later artefacts avoid earlier ones where possible (see PlacementContext.with_occupancy).
+    """
+
+    def __init__(self, repository, artefacts):
+        """
+        :param repository: ArtefactsRepository the artefacts of the given classes are selected from
+        :param artefacts: list of artefact classes and artefact objects, in the order they are inserted
+        """
+        self._repository = repository
+        self.artefacts = list(artefacts)
+        self.last_insertion = None  # descriptions of the artefacts inserted by the last call, see Artefact
+
+    def _select(self, seed=None):
+        """Provides the artefact objects of a call, classes are replaced by a randomly selected artefact."""
+        selected = []
+        for i, artefact in enumerate(self.artefacts):
+            item_seed = derive_seed(seed, i) if seed is not None else None
+            if isinstance(artefact, Artefact):
+                if item_seed is not None:
+                    artefact.reseed(item_seed)
+            else:
+                artefact = self._repository.get_random_instance(artefact, seed=item_seed)
+            selected.append(artefact)
+        return selected
+
+    def __call__(self, image, mask=None, seed=None, return_type='image', out=None, size=None):
+        """Inserts all artefacts into the image, see Artefact.__call__.
+
+        :param image: PIL Image object or uint8 ndarray (H, W, 3)
+        :param mask: mask, or a PlacementContext created for this image
+        :param seed: if given, the selection and randomness of every artefact only depend on this seed (and the
+            position of the artefact in the pipeline)
+        :param return_type: 'image' to obtain a PIL Image, 'ndarray' to obtain an uint8 ndarray
+        :param out: optional uint8 ndarray of the image shape the result is written to (return_type has to be
+            'ndarray')
+        :param size: optional (width, height) of the result, artefacts are inserted at this resolution
+        :return: PIL Image or ndarray with inserted artefacts
+        """
+        if return_type not in ('image', 'ndarray'):
+            raise ValueError(f"unknown return type '{return_type}'.")
+        if out is not None and return_type != 'ndarray':
+            raise ValueError("out can only be used with return type 'ndarray'.")
+
+        artefacts = self._select(seed)
+        with stage('compose', self):
+            resolution_scale = (1, 1)
+            if size is not None:
+                with stage('resize'):
+                    image, mask, resolution_scale = resize_input(image, mask, size)
+            with stage('convert'):
+                image = np.array(image, dtype='int16')
+
+            context = None
+            self.last_insertion = []
+            for artefact in artefacts:
+                with stage('call', artefact):
+                    if context is None:  # created with the settings of the first artefact
+                        context = artefact._placement_context(image, mask, resolution_scale).with_occupancy()
+                    artefact._insert(image, context)
+                self.last_insertion.append(artefact.last_insertion)
+
+            with stage('to_image'):
+                if return_type == 'ndarray':
+                    return to_array(image, out)
+                return to_image(image)
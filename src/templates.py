@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+from difflib import get_close_matches
+from os import path, listdir
+
+import numpy as np
+from PIL import Image
+from skimage import io
+
+from .common import atomic_write
+
+# increase whenever the way templates are created changes, this invalidates existing template caches
+TEMPLATE_FORMAT_VERSION = 4
+
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif']
+
+
+def load_templates(json_string, artefacts_path):
+    """Loads the artefact templates described by one entry of the meta.json file. For the "difference"
+    preprocessor each template is the difference of an image with and without the artefact, otherwise the
+    image is used as stamp (difference to white). Templates are trimmed symmetrically around their center (see
+    trim_template), so they are placed exactly like the untrimmed images.
+
+    :param json_string: entry of the meta.json file
+    :param artefacts_path: folder of the meta.json file
+    :return: list of int16 ndarrays
+    """
+    artefact_folder = path.join(artefacts_path, json_string['artefact_folder'])
+    templates = []
+
+    paths = sorted(f for f in listdir(artefact_folder) if path.splitext(f)[1] in IMAGE_EXTENSIONS)
+    if json_string.get('preprocessor') is not None and json_string.get('preprocessor') in "difference":
+        # find with and coresponding without images
+        paths_without = [f for f in paths if 'without' in f]
+        paths_with = [f for f in paths if f not in paths_without]
+        path_pairs = [(f, get_close_matches(f.replace('with', 'without'), paths_without, n=1, cutoff=0)[0]) for f in
+                      paths_with]
+        for pwith, pwithout in path_pairs:
+            im_with = np.array(Image.open(path.join(artefact_folder, pwith)))
+            im_with = im_with[:, :, 0:3]
+            im_without = io.imread(path.join(artefact_folder, pwithout))
+            templates.append(trim_template(np.subtract(im_with, im_without, dtype='int16'), centered=True))
+    else:
+        for path_im in paths:
+            im = np.array(Image.open(path.join(artefact_folder, path_im)))
+            templates.append(trim_template(np.subtract(im, np.full(im.shape, 255, dtype='int16')), centered=True))
+
+    return templates
+
+
+def trim_template(template, centered=False):
+    """Crops a template to the bounding box of its nonzero pixels, the pixels removed would not change an image.
+
+    :param template: ndarray (H, W, 3)
+    :param centered: if True, the crop is symmetric around the center of the template (see embed_in_image), so an
+        embedded template still changes the same pixels
+    :return: ndarray, a copy if the template was cropped
+    """
+    nonzero = np.any(template != 0, axis=2)
+    crop = []
+    for axis, n in enumerate(nonzero.shape):
+        used = np.flatnonzero(nonzero.any(axis=1 - axis))
+        if not len(used):
+            return template[0:1, 0:1].copy()
+        start, end = used[0], used[-1] + 1
+        if centered:
+            center = n // 2
+            extent = max(center - start, end - 1 - center)
+            start, end = center - extent, center + extent + 1
+            if start < 0 or end > n:
+                start, end = 0, n
+        crop.append(slice(start, end))
+    if crop[0] == slice(0, template.shape[0]) and crop[1] == slice(0, template.shape[1]):
+        return template
+    return template[crop[0], crop[1]].copy()  # copy, so the full template can be freed
+
+
+def quantize_template(template):
+    """Stores a template as int8 ndarray and a scale, values are rounded to multiples of the scale (templates
+    within [-127, 127] have a scale of 1 and are stored exactly).
+
+    :param template: int16 ndarray
+    :return: (int8 ndarray, scale) tuple, see dequantize_template
+    """
+    scale = max(float(np.max(np.abs(template), initial=0)) / 127, 1.)
+    return np.rint(template / scale).astype('int8'), scale
+
+
+def dequantize_template(quantized, scale):
+    """Inverse of quantize_template.
+
+    :return: int16 ndarray
+    """
+    if scale == 1:
+        return quantized.astype('int16')
+    return np.rint(quantized * np.float32(scale)).astype('int16')
+
+
+def template_sources_key(meta_path, entries):
+    """Hash identifying the state of all template sources: the content of the meta.json file and name, size and
+    modification time of every image in the artefact folders.
+
+    :param meta_path: location of the meta.json file
+    :param entries: artefact entries of the meta.json file
+    :return: hex digest
+    """
+    key = hashlib.sha256(f'template format {TEMPLATE_FORMAT_VERSION}\n'.encode())
+    with open(meta_path, 'rb') as meta_file:
+        key.update(meta_file.read())
+    for entry in entries:
+        artefact_folder = path.join(path.dirname(meta_path), entry['artefact_folder'])
+        for f in sorted(listdir(artefact_folder)):
+            if path.splitext(f)[1] in IMAGE_EXTENSIONS:
+                stat = os.stat(path.join(artefact_folder, f))
+                key.update(f'{entry["artefact_folder"]}/{f} {stat.st_size} {stat.st_mtime_ns}\n'.encode())
+    return key.hexdigest()
+
+
+class TemplateStore:
+    """Read-only store of the prepared templates of all artefacts, kept in one memory-mapped file. Templates are
+    only read from disk once they are accessed, and processes using the same store (e.g. forked or spawned
+    workers) share those pages through the page cache of the operating system.
+
+    The store is a folder holding the data file and an index. It is created if missing and rebuilt automatically if
+    the meta.json file or any artefact image changed (see template_sources_key).
+    """
+
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, store_path, meta_path, entries):
+        """
+        :param store_path: folder of the store
+        :param meta_path: location of the meta.json file
+        :param entries: artefact entries of the meta.json file
+        """
+        self.store_path = store_path
+        self.key = template_sources_key(meta_path, entries)
+
+        self._index = self._read_index()
+        if self._index is None:
+            self._index = self._build([load_templates(entry, path.dirname(meta_path)) for entry in entries])
+        self._data = np.asarray(np.load(path.join(store_path, self._index['data']), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self._index['templates'])
+
+    def templates(self, i):
+        """Provides the templates of the artefact entry i as read-only views of the memory-mapped file.
+
+        :param i: index of the artefact entry
+        :return: list of int16 ndarrays
+        """
+        return [self._data[offset:offset + int(np.prod(shape))].reshape(shape)
+                for offset, shape in self._index['templates'][i]]
+
+    def _read_index(self):
+        try:
+            with open(path.join(self.store_path, self.INDEX_FILE)) as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            return None
+        if index.get('key') != self.key or not path.exists(path.join(self.store_path, index['data'])):
+            return None
+        return index
+
+    def _build(self, templates):
+        os.makedirs(self.store_path, exist_ok=True)
+        index = {'key': self.key, 'data': f'templates-{self.key[:16]}.npy', 'templates': []}
+        offset = 0
+        for entry in templates:
+            index['templates'].append([])
+            for t in entry:
+                index['templates'][-1].append((offset, t.shape))
+                offset += t.size
+        data = np.concatenate([t.ravel() for entry in templates for t in entry]).astype('int16')
+
+        # write the data first and the index referring to it afterwards, both replace existing files atomically
+        atomic_write(path.join(self.store_path, index['data']), lambda f: np.save(f, data))
+        atomic_write(path.join(self.store_path, self.INDEX_FILE), lambda f: f.write(json.dumps(index).encode()))
+
+        # remove data of outdated stores
+        for f in listdir(self.store_path):
+            if f.startswith('templates-') and f.endswith('.npy') and f != index['data']:
+                os.remove(path.join(self.store_path, f))
+        return index
@@ -1,13 +1,16 @@
 import random
-from difflib import get_close_matches
-from os import path, listdir
+from os import path
 
 import numpy as np
-from PIL import Image
-from scipy import ndimage
-from skimage import io, transform
+from PIL import Image  # noqa: F401, demo.py obtains Image through `from src.types import *`
+from skimage import transform
 
-from .common import Sampler, embed_in_image, beta_distribution, to_image
+from .common import embed_in_image_inplace, artefact_footprint, beta_distribution, block_mean, blur_mask, \
+    compact_artefact, grid_shape, overlap_region, region_sum, resize_input, summed_area_table, to_array, to_image, \
+    warp_artefact, SparseArtefact, VariantBank, WARP_ORDERS
+from .placement import OccupancyIndex, PlacementContext
+from .profiling import count, stage
+from .templates import dequantize_template, load_templates, quantize_template, trim_template
 
 
 class Artefact:
@@ -23,62 +26,62 @@ class Artefact:
     in this class and used functions.
     """
 
-    def __new__(cls, json_string, artefacts_path, seed=None):
+    # artefact classes with the same placement policy share their probability distribution within a PlacementContext
+    _placement_policy = 'default'
+
+    def __new__(cls, json_string, artefacts_path, seed=None, **kwargs):
         """Instantiation of this class will provide some sort of factory behavior, meaning
         depending on the given json object (specifically on the class and subclass field) the
-        corresponding object will be returned.
+        corresponding object will be returned (see `artefact_type`).
         """
-        if json_string['class'] == "bubble":
-            return super().__new__(Bubble)
-        elif json_string['class'] == "marking":
-            if json_string['subclass'] == "circle":
-                return super().__new__(MarkingCircle)
-            elif json_string['subclass'] == "spot":
-                return super().__new__(MarkingSpot)
-        elif json_string['class'] == "ruler":
-            if json_string['subclass'] == "horizontal":
-                return super().__new__(RulerHorizontal)
-            elif json_string['subclass'] == "vertical":
-                return super().__new__(RulerVertical)
-        raise NotImplementedError("no matching class found.")
-
-    def __init__(self, json_string, artefacts_path, seed=None):
+        return super().__new__(artefact_type(json_string))
+
+    def __init__(self, json_string, artefacts_path, seed=None, sampling_cell=1, blur='exact', variant_bank=None,
+                 templates=None, template_dtype='int16', warp='chained'):
         """Default init function tries to load artefacts according to the given json string.
         See the example meta.json the expected structure of data.
         Also some default parameters for artefact augmentation and transformations are set.
 
         :param json_string:
         :param artefacts_path:
+        :param seed:
+        :param sampling_cell: size (in pixels) of the cells positions are sampled from, values > 1 sample on a
+            downsampled probability grid (e.g. 8), which is much cheaper for large images
+        :param blur: backend used to smooth (lesion-)masks ('exact', 'pyramid' or 'box'), see `blur_mask`
+        :param variant_bank: if set, transformed artefacts are cached in a VariantBank (scale and angle are
+            quantized), either True or a dict of VariantBank arguments (e.g. {'max_bytes': 2 ** 26, 'angle_step': 5})
+        :param templates: already loaded artefact templates (see `load_templates`), loaded from disk if None
+        :param template_dtype: 'int16', or 'int8' to keep the templates in half the memory (see `quantize_template`,
+            values are rounded to multiples of a scale if they exceed [-127, 127])
+        :param warp: how templates are transformed, 'chained' applies flip, resize and rotation one after the other,
+            'linear' or 'nearest' apply all of them in a single interpolation of the given kind (see `warp_artefact`),
+            which is considerably faster
         """
+        if template_dtype not in ('int16', 'int8'):
+            raise ValueError(f"unknown template dtype '{template_dtype}'.")
+        if warp != 'chained' and warp not in WARP_ORDERS:
+            raise ValueError(f"unknown warp mode '{warp}'.")
         self.json = json_string
         self._random = random.Random(seed)
+        self._sampling_cell = sampling_cell
+        self._blur = blur
+        self._warp = warp
+        if variant_bank:
+            self._variant_bank = VariantBank(**(variant_bank if isinstance(variant_bank, dict) else {}))
+        else:
+            self._variant_bank = None
         self._artefact_folder = path.join(artefacts_path, json_string['artefact_folder'])
-        self._artefact_images = []
+        self.last_insertion = None  # description of the artefacts inserted by the last call
 
         # load artefact images
-        paths = [f for f in listdir(self._artefact_folder) if path.splitext(f)[1] in ['.png', '.jpg', '.jpeg', '.gif']]
-        if json_string.get('preprocessor') is not None and json_string.get('preprocessor') in "difference":
-            # find with and coresponding without images
-            paths_without = [f for f in paths if 'without' in f]
-            paths_with = [f for f in paths if f not in paths_without]
-            path_pairs = [(f, get_close_matches(f.replace('with', 'without'), paths_without, n=1, cutoff=0)[0]) for f in
-                          paths_with]
-            for pwith, pwithout in path_pairs:
-                im_with = np.array(Image.open(path.join(self._artefact_folder, pwith)))
-                im_with = im_with[:, :, 0:3]
-                im_without = io.imread(path.join(self._artefact_folder, pwithout))
-                self._artefact_images.append(np.subtract(im_with, im_without, dtype='int16'))
-        else:
-            for path_im in paths:
-                im = np.array(Image.open(path.join(self._artefact_folder, path_im)))
-                self._artefact_images.append(np.subtract(im, np.full(im.shape, 255, dtype='int16')))
+        self._artefact_images = templates if templates is not None else load_templates(json_string, artefacts_path)
+        self._template_scales = None
+        if template_dtype == 'int8':
+            self._artefact_images, self._template_scales = zip(*[quantize_template(t) for t in self._artefact_images])
 
         # save number of artefacts
         self.json['number_of_artefacts'] = len(self._artefact_images)
 
-        # cache probability distribution function later
-        self._dpdf_cache = None
-
         # values used to perform random transformations and augmentations before
         # artefacts are inserted into an image
         # child classes will overwrite those values
@@ -93,7 +96,14 @@ class Artefact:
     def __repr__(self):
         return str(self.json)
 
-    def __call__(self, image, mask=None):
+    def reseed(self, seed=None):
+        """Resets the random generator of this artefact, the following calls only depend on the given seed.
+
+        :param seed:
+        """
+        self._random = random.Random(seed)
+
+    def __call__(self, image, mask=None, return_type='image', out=None, size=None):
         """This function takes the image object and inserts artefacts in the image, the position
         of artefacts can be influenced by the given mask object. This implementation is
         specific to the type of the artefact (see implementations in child classes).
@@ -101,103 +111,298 @@ class Artefact:
         is as little overlap as possible between artefacts, and if a (lesion-)mask is given,
         between artefacts and mask.
 
-        :param image: PIL Image object
-        :param mask: mask
-        :returns image: PIL Image with inserted artefacts
+        :param image: PIL Image object or uint8 ndarray (H, W, 3)
+        :param mask: mask, or a PlacementContext created for this image
+        :param return_type: 'image' to obtain a PIL Image, 'ndarray' to obtain an uint8 ndarray
+        :param out: optional uint8 ndarray of the image shape the result is written to (return_type has to be
+            'ndarray'), e.g. the image array itself or a view of a buffer shared between processes
+        :param size: optional (width, height) of the result, image and mask are resized first and artefacts are
+            inserted at this resolution (templates and the smoothing of the mask are scaled accordingly), which is
+            much cheaper than inserting at full resolution and resizing the result
+        :returns image: PIL Image or ndarray with inserted artefacts
+        """
+        if return_type not in ('image', 'ndarray'):
+            raise ValueError(f"unknown return type '{return_type}'.")
+        if out is not None and return_type != 'ndarray':
+            raise ValueError("out can only be used with return type 'ndarray'.")
+
+        with stage('call', self):
+            resolution_scale = (1, 1)
+            if size is not None:
+                with stage('resize'):
+                    image, mask, resolution_scale = resize_input(image, mask, size)
+
+            # convert image and obtain placement information of the mask
+            with stage('convert'):
+                image = np.array(image, dtype='int16')
+            self._insert(image, self._placement_context(image, mask, resolution_scale))
+            with stage('to_image'):
+                if return_type == 'ndarray':
+                    return to_array(image, out)
+                return to_image(image)
+
+    def apply_batch(self, images, masks=None, seeds=None, out=None):
+        """Applies this artefact to a batch of images of the same size without converting them to PIL Images. Each
+        image gets the same result as calling the artefact with it (after reseeding it with the seed of the image),
+        but images without mask share their placement distribution and one working buffer is used for all images.
+
+        :param images: uint8 ndarray of shape (N, H, W, 3)
+        :param masks: None or a sequence of N masks (e.g. a uint8 ndarray of shape (N, H, W)), each one may be None
+        :param seeds: optional sequence of N seeds
+        :param out: optional uint8 ndarray of the shape of images the results are written to (may be images)
+        :return: uint8 ndarray of shape (N, H, W, 3)
+        """
+        images = np.asarray(images)
+        if out is None:
+            out = np.empty(images.shape, dtype='uint8')
+        shared_context = PlacementContext(images.shape[1:3], sampling_cell=self._sampling_cell, blur=self._blur)
+
+        image = np.empty(images.shape[1:], dtype='int16')  # working buffer
+        for i in range(len(images)):
+            if seeds is not None:
+                self.reseed(seeds[i])
+            mask = masks[i] if masks is not None else None
+            with stage('call', self):
+                np.copyto(image, images[i])
+                self._insert(image, self._placement_context(image, shared_context if mask is None else mask))
+                to_array(image, out[i])
+        return out
+
+    def _insert(self, image, context):
+        """Inserts artefacts into the image in place, this implementation is specific to the type of the artefact.
+
+        :param image: int16 ndarray of the image, values may exceed [0, 255] afterwards
+        :param context: PlacementContext of the image
         """
-
-        # convert image and mask
-        image = np.array(image, dtype='int16')
-        if mask:
-            mask = np.array(mask, dtype='uint8')
-
-        # obtain dpdf if not done or image does not fit
-        if self._dpdf_cache is None or self._dpdf_cache.shape != image.shape:
-            self._dpdf_cache = beta_distribution(image.shape)  # obtain the beta continuous probability distribution
-
-        # if lesion mask is available, "remove" lesion region from dpdf array
-        if mask is not None:
-            mask_blurred = ndimage.gaussian_filter(mask[:, :], sigma=15)  # smooth the mask
-            mask_blurred = (mask_blurred.astype(float) / -255) + 1  # normalize [0,1] and invert
-            dpdf = np.multiply(self._dpdf_cache, mask_blurred)  # remove region of lesion from dpdf by multiplying
-        else:
-            dpdf = self._dpdf_cache
 
         # obtain sampler for this image
-        sampler = Sampler(dpdf, seed=self._random.random())
+        with stage('sampler'):
+            sampler = context.sampler(self._placement_policy, self._placement_distribution,
+                                      seed=self._random.random())
 
         # get current selection of (possibly randomly varied) artefacts
         # this function should be overwritten by each subclass
-        artefact_selection = self._get_random_artefacts()
+        with stage('transform'):
+            artefact_selection = self._get_random_artefacts(context.resolution_scale)
 
         # place artefacts in image with no overlap if possible (try a certain number - 10 times)
-        used_locations = np.ndarray(image.shape, dtype=np.bool)
-        for artefact in artefact_selection:
-            num_attempts = 0
-            while num_attempts < 10:  # try a maximum of 10 times
-                num_attempts += 1
-                pos = sampler.rand2d()  # get random position
-                pos_start = np.subtract(pos,
-                                        (np.floor(np.divide(artefact.shape[0:2], 2)).astype(int)))  # top left corner
-                pos_end = (np.add(pos_start, artefact.shape[0:2])).astype(int)  # bottom right corner position
-
-                # if no overlap between artefacts would occur
-                if not used_locations[pos_start[0]:pos_end[0], pos_start[1]:pos_end[1]].any():
-                    used_locations[pos_start[0]:pos_end[0], pos_start[1]:pos_end[1]] = True  # remember occupied area
-                    image = embed_in_image(image, artefact, pos)  # place artefact in image
-                    num_attempts = 10
-
-        return to_image(image)
-
-    def _get_random_artefacts(self):
+        with stage('placement'):
+            used_locations = self._occupancy(context)
+            for i, artefact in enumerate(artefact_selection):
+                for pos in sampler.rand2d_batch(10):  # try a maximum of 10 (pre-drawn) random positions
+                    count('placement_attempts')
+                    pos_start = np.subtract(pos, np.floor_divide(artefact.shape[0:2], 2))  # top left corner
+                    pos_end = np.add(pos_start, artefact.shape[0:2])  # bottom right corner position
+
+                    # if no overlap between artefacts would occur
+                    if not used_locations.overlaps(pos_start, pos_end):
+                        used_locations.add(pos_start, pos_end)  # remember occupied area
+                        embed_in_image_inplace(image, artefact, pos)  # place artefact in image
+                        self._record_position(i, pos)
+                        break
+                else:
+                    count('placement_failures')  # the artefact is left out
+
+    @staticmethod
+    def _occupancy(context):
+        """Provides the OccupancyIndex artefacts are placed in: the one shared by all artefacts placed with the
+        context (see PlacementContext.with_occupancy), or a new one only holding the artefacts of this call.
+
+        :param context: PlacementContext
+        :return: OccupancyIndex
+        """
+        return context.occupancy if context.occupancy is not None else OccupancyIndex(context.shape)
+
+    def _placement_context(self, image, mask, resolution_scale=(1, 1)):
+        """Returns the given PlacementContext, or creates one for the given mask.
+
+        :param image: image as ndarray
+        :param mask: mask, PlacementContext or None
+        :param resolution_scale: factors the image was resized by, see PlacementContext
+        :return: PlacementContext
+        """
+        if isinstance(mask, PlacementContext):
+            if mask.shape != image.shape[0:2]:
+                raise ValueError("placement context does not match the image size.")
+            return mask
+        return PlacementContext(image, mask, sampling_cell=self._sampling_cell, blur=self._blur,
+                                resolution_scale=resolution_scale)
+
+    def _placement_distribution(self, context):
+        """Provides the discrete probability distribution of artefact positions (on the sampling grid). By default
+        the beta distribution, where the (lesion-)mask region is "removed" if a mask is available.
+
+        :param context: PlacementContext
+        :return: 2d ndarray
+        """
+        # obtain the beta continuous probability distribution (its factors are cached for all artefacts)
+        dpdf = beta_distribution(context.shape, cell_size=context.sampling_cell)
+
+        # if lesion mask is available, "remove" lesion region from dpdf array
+        if context.weights is not None:
+            dpdf *= context.weights  # remove region of lesion from dpdf by multiplying
+        return dpdf
+
+    def _get_random_artefacts(self, resolution_scale=(1, 1)):
         """Selects some artefacts out of all available ones, according to the specifications set in
         self._augment. Then it applies random transformations controlled by self._transform on each
-        of those artefacts and then returns a list of those.
+        of those artefacts and then returns a list of those, scaled to the resolution of the image.
+
+        The selection is described in self.last_insertion, a JSON serializable dict holding name and class of this
+        artefact and for each selected artefact the index of its template, the transformation applied (flip, scale
+        and angle, None if not applied) and the position of its center (set once placed, see _record_position).
 
+        :param resolution_scale: (row, column) factors the image was resized by, see PlacementContext
         :return List of artefacts
         """
+        resolution_scale = None if tuple(resolution_scale) == (1, 1) else tuple(resolution_scale)
 
         # select artefacts
-        tmp = [np.copy(x) for x in self._artefact_images if self._random.random() > self._augment['remove_prob']]
+        tmp = [i for i in range(len(self._artefact_images)) if self._random.random() > self._augment['remove_prob']]
         # but ensure that at least one is selected
         if len(tmp) < 1:
-            tmp.append(np.copy(self._artefact_images[0]))
+            tmp.append(0)
 
         # duplicate artefacts
-        tmp.extend([np.copy(i) for i in tmp if self._random.random() < self._augment['replicate_prob']])
+        tmp.extend([i for i in tmp if self._random.random() < self._augment['replicate_prob']])
+
+        self.last_insertion = {'name': self.json.get('name'), 'class': type(self).__name__, 'artefacts': []}
 
         # alter artefacts
         for i, t in enumerate(tmp):
+            flip, scale, angle = None, None, None
+
             # flip
             if self._random.random() < self._transform['flip_prob']:
-                t = np.flip(t, axis=self._random.random() > .5)
+                flip = int(self._random.random() > .5)
 
             # resize
             if self._random.random() < self._transform['resize_prob']:
-                new_dimensions = np.floor(np.multiply(t.shape[0:2],
-                                                      self._random.uniform(self._transform['resize_scaling_range'][0],
-                                                                           self._transform['resize_scaling_range'][1])))
-                new_dimensions = np.append(new_dimensions, t.shape[2])
-                t = transform.resize(t, new_dimensions, preserve_range=True, anti_aliasing=True)
-                t = t.astype(t.dtype)
+                scale = self._random.uniform(self._transform['resize_scaling_range'][0],
+                                             self._transform['resize_scaling_range'][1])
 
             # rotate
             if self._random.random() < self._transform['rotate_prob']:
-                t = transform.rotate(t, angle=self._random.randint(self._transform['rotate_range'][0],
-                                                                   self._transform['rotate_range'][1]),
-                                     resize=True,
-                                     mode='constant', cval=0, preserve_range=True)
-                t = t.astype(t.dtype)
-            tmp[i] = t
+                angle = self._random.randint(self._transform['rotate_range'][0], self._transform['rotate_range'][1])
+
+            if self._variant_bank is not None:  # record the values actually used
+                scale = None if scale is None else self._variant_bank.quantize_scale(scale)
+                angle = None if angle is None else self._variant_bank.quantize_angle(angle)
+            self.last_insertion['artefacts'].append({'template': t, 'flip': flip, 'scale': scale, 'angle': angle,
+                                                     'position': None})
+            tmp[i] = self._get_variant(t, flip, scale, angle, resolution_scale)
 
         return tmp
 
+    def _record_position(self, i, pos):
+        """Records the position the i-th artefact of the current selection was placed at, see last_insertion."""
+        self.last_insertion['artefacts'][i]['position'] = [int(pos[0]), int(pos[1])]
+
+    def _get_variant(self, index, flip=None, scale=None, angle=None, resolution_scale=None):
+        """Provides the artefact template with the given index, flipped (along axis flip), resized (by factor scale)
+        and rotated (by angle degrees), None skips the transformation. Finally it is resized by the (row, column)
+        factors of resolution_scale. If a variant bank is used, scale and angle are quantized and the result is
+        cached. The returned artefact must not be modified.
+
+        :return: artefact as ndarray
+        """
+        if self._variant_bank is None:
+            return self._transform_artefact(self._template(index), flip, scale, angle, resolution_scale,
+                                            self._warp)
+
+        scale = None if scale is None else self._variant_bank.quantize_scale(scale)
+        angle = None if angle is None else self._variant_bank.quantize_angle(angle)
+        # the template is only obtained (and dequantized) if the variant is not in the bank yet
+        return self._variant_bank.get((index, flip, scale, angle, resolution_scale),
+                                      lambda: self._transform_artefact(self._template(index), flip, scale, angle,
+                                                                       resolution_scale, self._warp))
+
+    def _template(self, index):
+        """Provides the artefact template with the given index as int16 ndarray."""
+        if self._template_scales is None:
+            return self._artefact_images[index]
+        return dequantize_template(self._artefact_images[index], self._template_scales[index])
+
+    @staticmethod
+    def _transform_artefact(t, flip=None, scale=None, angle=None, resolution_scale=None, warp='chained'):
+        # the same factor along both axes commutes with the rotation, so it is applied together with the resize
+        if resolution_scale is not None and resolution_scale[0] == resolution_scale[1]:
+            scale = resolution_scale[0] * (scale if scale is not None else 1)
+            resolution_scale = None
+
+        if warp != 'chained':
+            if scale is not None or angle is not None or resolution_scale is not None:
+                t = trim_template(warp_artefact(t, flip, scale, angle, resolution_scale, warp), centered=True)
+            elif flip is not None:
+                t = np.flip(t, axis=flip)  # no interpolation needed
+            return compact_artefact(t)
+
+        # flip
+        if flip is not None:
+            t = np.flip(t, axis=flip)
+
+        # resize
+        if scale is not None:
+            new_dimensions = np.maximum(np.floor(np.multiply(t.shape[0:2], scale)), 1)
+            new_dimensions = np.append(new_dimensions, t.shape[2])
+            t = transform.resize(t, new_dimensions, preserve_range=True, anti_aliasing=True)
+
+        # rotate
+        if angle is not None:
+            t = transform.rotate(t, angle=angle, resize=True, mode='constant', cval=0, preserve_range=True)
+
+        # resize to the resolution of the image
+        if resolution_scale is not None:
+            new_dimensions = np.maximum(np.floor(np.multiply(t.shape[0:2], resolution_scale)), 1)
+            new_dimensions = np.append(new_dimensions, t.shape[2])
+            t = transform.resize(t, new_dimensions, preserve_range=True, anti_aliasing=True)
+
+        # remove the empty border created by rotating (and interpolating), and keep artefacts covering a small part
+        # of their bounding box as sparse artefacts, so placing them costs time proportional to the pixels changed
+        if scale is not None or angle is not None or resolution_scale is not None:
+            t = trim_template(t, centered=True)
+        return compact_artefact(t)
+
+    def warm_variants(self, max_variants=None):
+        """Fills the variant bank ahead of time with all (quantized) variants the transformation settings of this
+        artefact can produce, as long as they fit into the bank.
+
+        :param max_variants: optional upper limit of variants to create
+        :return: number of variants in the bank
+        """
+        if self._variant_bank is None:
+            raise ValueError("no variant bank is used by this artefact.")
+        bank = self._variant_bank
+
+        flips = [None] + ([0, 1] if self._transform['flip_prob'] > 0 else [])
+        scales = [None]
+        if self._transform['resize_prob'] > 0:
+            low, high = (bank.quantize_scale(x) for x in self._transform['resize_scaling_range'])
+            scales += sorted({bank.quantize_scale(x)
+                              for x in np.arange(low, high + bank.scale_step / 2, bank.scale_step)})
+        angles = [None]
+        if self._transform['rotate_prob'] > 0:
+            low, high = self._transform['rotate_range']
+            angles += sorted({bank.quantize_angle(x) for x in range(low, high + 1)})
+
+        created = 0
+        for index in range(len(self._artefact_images)):
+            for flip in flips:
+                for scale in scales:
+                    for angle in angles:
+                        if max_variants is not None and created >= max_variants or bank.nbytes >= bank.max_bytes:
+                            return len(bank)
+                        if (index, flip, scale, angle, None) not in bank:
+                            self._get_variant(index, flip, scale, angle)
+                            created += 1
+        return len(bank)
+
 
 class Bubble(Artefact):
     """Represents artefacts of type bubble."""
 
-    def __init__(self, json_string, artefacts_path, seed=None):
-        super().__init__(json_string, artefacts_path, seed)
+    def __init__(self, json_string, artefacts_path, seed=None, **kwargs):
+        super().__init__(json_string, artefacts_path, seed, **kwargs)
 
         self._augment.update({"replicate_prob": .8,
                               "remove_prob": .1})
@@ -210,8 +415,8 @@ class Marking(Artefact):
 class MarkingCircle(Marking):
     """Represents ink markings that are arranged around a lesion, or look like circle around a lesion."""
 
-    def __init__(self, json_string, artefacts_path, seed=None):
-        super().__init__(json_string, artefacts_path, seed)
+    def __init__(self, json_string, artefacts_path, seed=None, **kwargs):
+        super().__init__(json_string, artefacts_path, seed, **kwargs)
 
         self._augment.update({"replicate_prob": 0,
                               "remove_prob": 0})
@@ -219,38 +424,34 @@ class MarkingCircle(Marking):
                                 "resize_scaling_range": [.8, 1.4],
                                 "rotate_prob": .9})
 
-    def __call__(self, image, mask=None):
+    def _insert(self, image, context):
         """Artefacts of this class are always oriented around the region of lesion,
 
         :param image:
-        :param mask:
-        :return:
+        :param context:
         """
 
-        # convert image
-        image = np.array(image, dtype='int16')
-
         # if mask is available use its center, otherwise use the center of the image
-        if mask is not None:
-            mask = np.array(mask, dtype='uint8')
-            pos = ndimage.center_of_mass(mask)
-            pos = [int(pos[0]), int(pos[1])]
-        else:
-            pos = (np.divide(image.shape[0:2], 2)).astype(np.int)
+        with stage('mask'):
+            pos = context.center_of_mass
 
         # transform the image ...
-        artefact_selection = self._get_random_artefacts()
+        with stage('transform'):
+            artefact_selection = self._get_random_artefacts(context.resolution_scale)
 
-        # ... and place it there
-        image = embed_in_image(image, artefact_selection[0], pos)
-        return to_image(image)
+        # ... and place it there (regardless of other artefacts)
+        with stage('placement'):
+            embed_in_image_inplace(image, artefact_selection[0], pos)
+            self._record_position(0, pos)
+            if context.occupancy is not None:
+                context.occupancy.add(*OccupancyIndex.extent(artefact_selection[0], pos))
 
 
 class MarkingSpot(Marking):
     """Represents ink markings occurring somewhere next to the lesion, similar to bubble artefacts."""
 
-    def __init__(self, json_string, artefacts_path, seed=None):
-        super().__init__(json_string, artefacts_path, seed)
+    def __init__(self, json_string, artefacts_path, seed=None, **kwargs):
+        super().__init__(json_string, artefacts_path, seed, **kwargs)
 
         self._augment.update({"replicate_prob": .8,
                               "remove_prob": .3})
@@ -263,8 +464,10 @@ class Ruler(Artefact):
 class RulerHorizontal(Ruler):
     """Horizontal Rulers are arranged under an lesion and mostly centered at the lesion."""
 
-    def __init__(self, json_string, artefacts_path, seed=None):
-        super().__init__(json_string, artefacts_path, seed)
+    _placement_policy = 'ruler_horizontal'
+
+    def __init__(self, json_string, artefacts_path, seed=None, **kwargs):
+        super().__init__(json_string, artefacts_path, seed, **kwargs)
 
         self._augment.update({"replicate_prob": 0,
                               "remove_prob": 0})
@@ -272,22 +475,46 @@ class RulerHorizontal(Ruler):
                                 "rotate_prob": 1,
                                 "rotate_range": [-20, 20]})
 
-    def __call__(self, image, mask=None):
+    def _insert(self, image, context):
 
-        # convert image
-        image = np.array(image, dtype='int16')
-        if mask:
-            mask = np.array(mask, dtype='uint8')
+        # obtain the sampler with modified dpdf (mask removed)
+        with stage('sampler'):
+            sampler = context.sampler(self._placement_policy, self._placement_distribution,
+                                      seed=self._random.random())
 
+        # get current selection of (possibly randomly varied) artefacts
+        with stage('transform'):
+            artefact_selection = self._get_random_artefacts(context.resolution_scale)
+
+        with stage('placement'):
+            for i, artefact in enumerate(artefact_selection):
+                if context.occupancy is None:
+                    pos = sampler.rand2d()  # get random position
+                else:
+                    # avoid the artefacts already placed if possible (try 10 times), the last position is used
+                    # regardless
+                    for pos in sampler.rand2d_batch(10):
+                        count('placement_attempts')
+                        if not context.occupancy.overlaps(*OccupancyIndex.extent(artefact, pos)):
+                            break
+                    else:
+                        count('placement_failures')
+                    context.occupancy.add(*OccupancyIndex.extent(artefact, pos))
+                embed_in_image_inplace(image, artefact, pos)  # place artefact in image
+                self._record_position(i, pos)
+
+    def _placement_distribution(self, context):
         # only consider the middle (1/3 of the imagewith), if available (under the lesion image and in the lower 1/3
-        #  section of the image)
-        middle_mask = np.zeros(image.shape[0:2], dtype=np.bool)
-        middle_mask[int(middle_mask.shape[0] / 3 * 2):int(middle_mask.shape[0]),
-                    int(middle_mask.shape[1] / 3):int(middle_mask.shape[1] / 3 * 2)] = True
+        #  section of the image), the region is given in cells of the sampling grid (pixels if cell size is 1)
+        cell = context.sampling_cell
+        middle_mask = np.zeros(grid_shape(context.shape, cell), dtype=bool)
+        middle_mask[-(-int(context.shape[0] / 3 * 2) // cell):middle_mask.shape[0],
+                    -(-int(context.shape[1] / 3) // cell):int(context.shape[1] / 3 * 2) // cell] = True
 
         # if lesion mask is available, "remove" lesion region from dpdf array
-        if mask is not None and np.max(mask) > 0:
-            mask_blurred = ndimage.gaussian_filter(mask[:, :], sigma=15)  # smooth the mask
+        mask = None
+        if context.mask is not None and np.max(context.mask) > 0:
+            mask_blurred = context.blurred_grid  # smoothed mask
             mask = mask_blurred / np.max(mask_blurred)  # normalize [0,1]
             mask = mask * -1 + 1
             mask[~middle_mask] = 0  # remove middle mask areas from image_mask
@@ -295,78 +522,133 @@ class RulerHorizontal(Ruler):
         if mask is None or np.max(mask) == 0:  # in case to much is removed above or empty mask was given
             mask = middle_mask.astype(np.float16)
 
-        # obtain dpdf if not done or image does not fit
-        if self._dpdf_cache is None or self._dpdf_cache.shape != image.shape:
-            self._dpdf_cache = beta_distribution(image.shape)  # obtain the beta continuous probability distribution
-
-        # obtain the sampler with modified dpdf (mask removed)
-        sampler = Sampler(np.multiply(self._dpdf_cache, mask), seed=self._random.random())
-
-        # get current selection of (possibly randomly varied) artefacts
-        artefact_selection = self._get_random_artefacts()
-
-        for artefact in artefact_selection:
-            pos = sampler.rand2d()  # get random position
-            image = embed_in_image(image, artefact, pos)  # place artefact in image
-
-        return to_image(image)
+        # obtain the beta continuous probability distribution (its factors are cached for all artefacts)
+        dpdf = beta_distribution(context.shape, cell_size=cell)
+        return np.multiply(dpdf, mask)
 
 
 class RulerVertical(Ruler):
     """'Vertical' rulers are arranged in peripheral regions of the image, often in its corners."""
 
-    def __init__(self, json_string, artefacts_path, seed=None):
-        super().__init__(json_string, artefacts_path, seed)
+    _placement_policy = 'ruler_vertical'
+
+    def __init__(self, json_string, artefacts_path, seed=None, **kwargs):
+        super().__init__(json_string, artefacts_path, seed, **kwargs)
 
         self._augment.update({"replicate_prob": 0,
                               "remove_prob": 0})
         self._transform.update({"rotate_prob": 1})
 
-    def __call__(self, image, mask=None):
+    def _insert(self, image, context):
 
-        # convert image
-        image = np.array(image, dtype='int16')
+        # obtain placement information of the mask
+        with stage('mask'):
+            mask = self._lesion_mask(context)
+            mask_table = context.cached('ruler_vertical_mask_table', lambda c: summed_area_table(mask))
 
-        # as the mask is used in the next step, generate one if no mask was given
-        # this mask will have an circular shape centered in the middle of the image
-        if mask:
-            mask = np.array(mask, dtype='uint8')
-        else:
-            x = np.linspace(-2.0, 2.0, image.shape[1])
-            y = np.linspace(-2.0, 2.0, image.shape[0])
+        # place artefacts in image with no overlap with the lesion if possible
+        # (try a certain number - 26 times)
+        with stage('sampler'):
+            sampler = context.sampler(self._placement_policy, self._placement_distribution,
+                                      seed=self._random.random())
+
+        # get current selection of (possibly randomly varied) artefacts
+        with stage('transform'):
+            artefact_selection = self._get_random_artefacts(context.resolution_scale)
+
+        with stage('placement'):
+            for i, artefact in enumerate(artefact_selection):
+                footprint = artefact_footprint(artefact)  # pixels changed by the artefact once embedded
+                for pos in sampler.rand2d_batch(26):  # pre-drawn random positions, the last one is used regardless
+                    count('placement_attempts')
+                    # check if the artefact would intersect with the lesion mask (or artefacts already placed)
+                    if not self._intersects(footprint, pos, mask, mask_table) and (
+                            context.occupancy is None or
+                            not context.occupancy.overlaps(*OccupancyIndex.extent(artefact, pos))):
+                        break
+                else:
+                    count('placement_failures')  # placed on the lesion
+                if context.occupancy is not None:
+                    context.occupancy.add(*OccupancyIndex.extent(artefact, pos))
+                embed_in_image_inplace(image, artefact, pos)  # place artefact in image
+                self._record_position(i, pos)
+
+    @staticmethod
+    def _intersects(footprint, pos, mask, mask_table):
+        """Tests if an artefact placed at pos would intersect with the mask, only the footprint of the artefact is
+        considered. Regions without or with lesion only are decided in constant time using the summed-area table.
+
+        :param footprint: 2d boolean ndarray or SparseArtefact, pixels covered by the artefact
+        :param pos: position of the center of the artefact
+        :param mask: 2d boolean ndarray
+        :param mask_table: summed-area table of the mask
+        :return: True if any pixel of the footprint lies on the mask
+        """
+        region = overlap_region(mask.shape, footprint.shape, pos)
+        if region is None:
+            return False
+        target_region, source_region = region
+
+        lesion = region_sum(mask_table, target_region)
+        if lesion == 0:
+            return False
+        if isinstance(footprint, SparseArtefact):
+            rows, cols, _ = footprint.target_coordinates(pos, mask.shape)
+            return bool(mask[rows, cols].any())
+        if lesion == footprint[source_region].size:
+            return bool(footprint[source_region].any())
+        return bool(np.any(footprint[source_region] & mask[target_region]))
+
+    @staticmethod
+    def _lesion_mask(context):
+        """Provides the mask of the context as boolean array. As the mask is needed for placement, one is
+        generated if no mask was given, this mask will have an circular shape centered in the middle of the image.
+
+        :param context: PlacementContext
+        :return: 2d boolean ndarray
+        """
+        def build(c):
+            if c.mask is not None:
+                return c.mask.astype(bool)
+            x = np.linspace(-2.0, 2.0, c.shape[1])
+            y = np.linspace(-2.0, 2.0, c.shape[0])
             x, y = np.meshgrid(x, y)
             r = np.sqrt((x - 0.0) ** 2 + (y - 0.0) ** 2)
-            mask = (r < 1).astype(np.uint8) * np.iinfo(np.uint8).max
+            return r < 1
+        return context.cached('ruler_vertical_mask', build)
 
-        # obtain dpdf if not done or image does not fit
-        if self._dpdf_cache is None or self._dpdf_cache.shape != image.shape:
-            self._dpdf_cache = beta_distribution(image.shape)  # obtain the beta continuous probability distribution
+    def _placement_distribution(self, context):
+        # obtain the beta continuous probability distribution (its factors are cached for all artefacts)
+        dpdf = beta_distribution(context.shape, cell_size=context.sampling_cell)
 
         # "remove" lesion region from dpdf array
-        mask_blurred = ndimage.gaussian_filter(mask[:, :], sigma=15)  # smooth the mask
-        mask_blurred = (mask_blurred.astype(float) / -255) + 1  # normalize [0,1] and invert
-        dpdf_tmp = np.multiply(self._dpdf_cache, mask_blurred)  # remove region of lesion from dpdf by multiplying
+        if context.mask is not None:
+            mask_blurred = context.weights
+        else:
+            mask = self._lesion_mask(context).astype(np.uint8) * np.iinfo(np.uint8).max
+            with stage('blur'):
+                mask_blurred = blur_mask(mask, context.sigma, context.blur)  # smooth the mask
+            mask_blurred = (block_mean(mask_blurred, context.sampling_cell) / -255) + 1  # normalize [0,1] and invert
+        return np.multiply(dpdf, mask_blurred)  # remove region of lesion from dpdf by multiplying
 
-        # place artefacts in image with no overlap with the lesion if possible
-        # (try a certain number - 25 times)
-        sampler = Sampler(dpdf_tmp, seed=self._random.random())
 
-        # get current selection of (possibly randomly varied) artefacts
-        artefact_selection = self._get_random_artefacts()
-
-        for artefact in artefact_selection:
-            num_attempts = 0
-            while True:
-                num_attempts += 1
-                pos = sampler.rand2d()  # get random position
-
-                # check if the artefact would intersect with the lesion mask
-                artefact_image_sized = embed_in_image(np.zeros(image.shape, dtype=image.dtype), artefact, pos)
-                artefact_image_sized_bool = np.logical_or.reduce(artefact_image_sized, axis=2)
-                mask_bool = mask.astype(bool)
-                intersection = artefact_image_sized_bool & mask_bool
-                if not np.any(intersection) or num_attempts > 25:
-                    image = embed_in_image(image, artefact, pos)  # place artefact in image
-                    break
-
-        return to_image(image)
+def artefact_type(json_string):
+    """Provides the Artefact class matching an entry of the meta.json file (specifically its class and
+    subclass field).
+
+    :param json_string: entry of the meta.json file
+    :return: subclass of Artefact
+    """
+    if json_string['class'] == "bubble":
+        return Bubble
+    elif json_string['class'] == "marking":
+        if json_string['subclass'] == "circle":
+            return MarkingCircle
+        elif json_string['subclass'] == "spot":
+            return MarkingSpot
+    elif json_string['class'] == "ruler":
+        if json_string['subclass'] == "horizontal":
+            return RulerHorizontal
+        elif json_string['subclass'] == "vertical":
+            return RulerVertical
+    raise NotImplementedError("no matching class found.")
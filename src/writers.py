@@ -0,0 +1,303 @@
+import io
+import json
+import os
+import tarfile
+import tempfile
+from os import path
+
+import numpy as np
+from PIL import Image
+
+from .common import atomic_write
+
+
+class PngWriter:
+    """Stores every generated image as png file in the target folder of its pair (the third element of the pair),
+    named after its artefact class (e.g. 'bubble.png').
+    """
+
+    sharded = False
+
+    def __init__(self, compress_level=1):
+        """
+        :param compress_level: zlib compression level of the png files (0-9)
+        """
+        self.compress_level = compress_level
+
+    def encode(self, sample):
+        """Writes the images of a sample, called by the writer threads of the pipeline (see generate_dataset).
+
+        :param sample: dict describing a processed pair, see `generation._insert_pair`
+        :return: manifest records of the images written
+        """
+        pair = sample['pair']
+        records = []
+        for name, target, insertion in sample['results']:
+            output = path.join(pair[2], name)
+            target.save(output, 'png', compress_level=self.compress_level)
+            records.append({'output': output, 'image': pair[0], 'mask': pair[1], 'source': sample['source'],
+                            **insertion})
+        return records
+
+    def shard(self, index):
+        """The files of a sample are complete once encoded, so there is nothing to collect."""
+        return _PngShard()
+
+
+class _PngShard:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def append(self, encoded):
+        return encoded
+
+
+class ShardWriter:
+    """Base class of writers storing many samples in a few large files (shards) instead of one file per image.
+    Every sample holds the images generated for one pair, the mask, optionally the source image and its metadata:
+    the id of the image, the source files and the artefacts inserted (see Artefact.last_insertion).
+
+    Each chunk of pairs processed by a worker is written to its own shard, shards are numbered by the chunk (not
+    the worker), so the output does not depend on the number of workers. Samples are encoded by the writer threads
+    of a worker and appended to its shard in order. A shard is written to a temporary file first and only appears
+    under its name once complete.
+    """
+
+    sharded = True
+    extension = None
+
+    def __init__(self, target_dir, prefix='shard', shard_size=256, include_sources=True):
+        """
+        :param target_dir: folder the shards are written to
+        :param prefix: file name prefix of the shards, followed by the number of the shard
+        :param shard_size: number of pairs (samples) per shard
+        :param include_sources: if True, the source image is stored in every sample as well
+        """
+        self.target_dir = target_dir
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.include_sources = include_sources
+
+    def shard_path(self, index):
+        return path.join(self.target_dir, f'{self.prefix}-{index:05d}{self.extension}')
+
+    @staticmethod
+    def _meta(sample):
+        pair = sample['pair']
+        return {'id': sample['id'], 'image': pair[0], 'mask': pair[1], 'source': sample['source'],
+                'artefacts': {_image_name(name): insertion for name, _, insertion in sample['results']}}
+
+
+def _image_name(name):
+    """Name of a generated image within a sample, the file name of the artefact class without extension."""
+    return path.splitext(name)[0]
+
+
+class TarShardWriter(ShardWriter):
+    """Writes samples to tar files in the layout used by WebDataset: all files of a sample share the image id as
+    prefix, e.g. 'ISIC_0024311.bubble.npy', 'ISIC_0024311.mask.png' and 'ISIC_0024311.json'. Source images and
+    masks are stored as read (in their original format), generated images as .npy (no encoding cost) or .png.
+    Shards can be read sequentially as a stream, see `read_tar_shard`.
+    """
+
+    extension = '.tar'
+
+    def __init__(self, target_dir, prefix='shard', shard_size=256, include_sources=True, image_format='npy',
+                 compress_level=1):
+        """
+        :param image_format: format of the generated images, 'npy' or 'png'
+        :param compress_level: zlib compression level of png images (0-9)
+        """
+        if image_format not in ('npy', 'png'):
+            raise ValueError(f"unknown image format '{image_format}'.")
+        super().__init__(target_dir, prefix, shard_size, include_sources)
+        self.image_format = image_format
+        self.compress_level = compress_level
+
+    def encode(self, sample):
+        """Encodes the files of a sample, called by the writer threads of the pipeline.
+
+        :param sample: dict describing a processed pair, see `generation._insert_pair`
+        :return: (id, list of (file name, content) tuples) tuple
+        """
+        key, pair = sample['id'], sample['pair']
+        files = []
+        for name, target, _ in sample['results']:
+            content = io.BytesIO()
+            if self.image_format == 'npy':
+                np.save(content, np.asarray(target))
+            else:
+                target.save(content, 'png', compress_level=self.compress_level)
+            files.append((f'{key}.{_image_name(name)}.{self.image_format}', content.getvalue()))
+        if self.include_sources:
+            files.append((f'{key}.image{path.splitext(pair[0])[1]}', sample['files'][0]))
+        if pair[1]:
+            files.append((f'{key}.mask{path.splitext(pair[1])[1]}', sample['files'][1]))
+        files.append((f'{key}.json', json.dumps(self._meta(sample)).encode()))
+        return key, files
+
+    def shard(self, index):
+        return _TarShard(self.shard_path(index))
+
+
+class _TarShard:
+    def __init__(self, shard_path):
+        self.shard_path = shard_path
+
+    def __enter__(self):
+        handle, self._tmp_path = tempfile.mkstemp(dir=path.dirname(path.abspath(self.shard_path)))
+        self._file = os.fdopen(handle, 'wb')
+        self._tar = tarfile.open(fileobj=self._file, mode='w', format=tarfile.PAX_FORMAT)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._tar.close()
+        self._file.close()
+        if exc_type is None:
+            os.replace(self._tmp_path, self.shard_path)
+        else:
+            os.remove(self._tmp_path)
+        return False
+
+    def append(self, encoded):
+        key, files = encoded
+        for name, content in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            self._tar.addfile(info, io.BytesIO(content))
+        return [{'output': f'{self.shard_path}/{name}'} for name, _ in files]
+
+
+def read_tar_shard(shard_path):
+    """Reads the samples of a tar shard (see TarShardWriter) as a stream, one after the other.
+
+    :param shard_path: location of the shard
+    :return: iterator over dicts holding the 'id', 'meta' (dict) and 'mask' and 'image' (uint8 ndarrays, None if
+        not stored) of a sample and its generated images as 'images' (dict of uint8 ndarrays)
+    """
+    sample = None
+    with tarfile.open(shard_path, mode='r|') as tar:
+        for member in tar:
+            key, name, extension = _split_member(member.name)
+            if sample is None or sample['id'] != key:
+                if sample is not None:
+                    yield sample
+                sample = {'id': key, 'meta': None, 'image': None, 'mask': None, 'images': {}}
+            content = tar.extractfile(member).read()
+            if extension == 'json':
+                sample['meta'] = json.loads(content)
+            elif extension == 'npy':
+                sample['images'][name] = np.load(io.BytesIO(content))
+            else:
+                array = np.asarray(Image.open(io.BytesIO(content)))
+                if name in ('image', 'mask'):
+                    sample[name] = array
+                else:
+                    sample['images'][name] = array
+    if sample is not None:
+        yield sample
+
+
+def _split_member(member_name):
+    """Splits the name of a file in a tar shard into id, name and extension, e.g. 'ISIC_0024311.bubble.npy'."""
+    rest, extension = member_name.rsplit('.', 1)
+    if extension == 'json':
+        return rest, None, extension
+    key, name = rest.rsplit('.', 1)
+    return key, name, extension
+
+
+class NpyShardWriter(ShardWriter):
+    """Writes samples as raw uint8 arrays into one binary file per shard, next to a json index holding the offset and
+    shape of every array and the metadata of every sample. Shards are read (sequentially or in any order) without
+    decoding by memory mapping the binary file, see `read_npy_shard`.
+    """
+
+    extension = '.bin'
+    ALIGNMENT = 64  # arrays start at multiples of this number of bytes
+
+    def encode(self, sample):
+        """Collects the arrays of a sample, called by the writer threads of the pipeline.
+
+        :param sample: dict describing a processed pair, see `generation._insert_pair`
+        :return: (metadata, dict of ndarrays) tuple
+        """
+        arrays = {_image_name(name): np.asarray(target, dtype='uint8') for name, target, _ in sample['results']}
+        if self.include_sources:
+            arrays['image'] = np.asarray(sample['image'], dtype='uint8')
+        if sample['mask'] is not None:
+            arrays['mask'] = np.asarray(sample['mask'], dtype='uint8')
+        return self._meta(sample), arrays
+
+    def shard(self, index):
+        return _NpyShard(self.shard_path(index), self.ALIGNMENT)
+
+
+class _NpyShard:
+    def __init__(self, shard_path, alignment):
+        self.shard_path = shard_path
+        self.index_path = path.splitext(shard_path)[0] + '.json'
+        self.alignment = alignment
+
+    def __enter__(self):
+        handle, self._tmp_path = tempfile.mkstemp(dir=path.dirname(path.abspath(self.shard_path)))
+        self._file = os.fdopen(handle, 'wb')
+        self._samples = []
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.close()
+        if exc_type is None:
+            os.replace(self._tmp_path, self.shard_path)
+            index = json.dumps({'data': path.basename(self.shard_path), 'samples': self._samples}).encode()
+            atomic_write(self.index_path, lambda f: f.write(index))  # the index is written last
+        else:
+            os.remove(self._tmp_path)
+        return False
+
+    def append(self, encoded):
+        meta, arrays = encoded
+        entries = {}
+        for name, array in arrays.items():
+            self._file.write(b'\0' * (-self._file.tell() % self.alignment))
+            entries[name] = {'offset': self._file.tell(), 'shape': list(array.shape)}
+            self._file.write(np.ascontiguousarray(array).data)
+        self._samples.append({'id': meta['id'], 'meta': meta, 'arrays': entries})
+        return [{'output': f'{self.shard_path}/{meta["id"]}.{name}'} for name in arrays]
+
+
+def read_npy_shard(shard_path):
+    """Reads the samples of a shard written by NpyShardWriter, arrays are memory mapped views into the shard.
+
+    :param shard_path: location of the binary file (.bin) or of the index (.json) of the shard
+    :return: iterator over dicts in the format of `read_tar_shard`
+    """
+    with open(path.splitext(shard_path)[0] + '.json') as index_file:
+        index = json.load(index_file)
+    data = np.memmap(path.join(path.dirname(shard_path), index['data']), dtype='uint8', mode='r')
+    for entry in index['samples']:
+        sample = {'id': entry['id'], 'meta': entry['meta'], 'image': None, 'mask': None, 'images': {}}
+        for name, array in entry['arrays'].items():
+            size = int(np.prod(array['shape']))
+            view = data[array['offset']:array['offset'] + size].reshape(array['shape'])
+            if name in ('image', 'mask'):
+                sample[name] = view
+            else:
+                sample['images'][name] = view
+        yield sample
+
+
+def read_shards(shard_paths):
+    """Reads the samples of several shards (tar or npy, see read_tar_shard and read_npy_shard) one after the other.
+
+    :param shard_paths: list of shard locations, e.g. sorted(glob('dataset/shard-*.tar'))
+    :return: iterator over sample dicts
+    """
+    for shard_path in shard_paths:
+        if shard_path.endswith('.tar'):
+            yield from read_tar_shard(shard_path)
+        else:
+            yield from read_npy_shard(shard_path)
@@ -0,0 +1,47 @@
+import glob
+
+import numpy as np
+import pytest
+from PIL import Image
+from scipy import ndimage
+
+from src.common import blur_mask, BLUR_ERROR_BOUNDS
+
+SIGMAS = [1, 2, 3, 8, 11.25, 15, 24, 40]  # incl. scaled sigmas (see resolution_scale) and box edge cases
+
+
+def bundled_masks():
+    return [np.array(Image.open(f).convert('L')) for f in sorted(glob.glob('data/test_masks/*.png'))]
+
+
+def synthetic_masks():
+    rand = np.random.RandomState(0)
+    masks = [np.full((1, 1), 255, np.uint8),  # tiny
+             (rand.rand(3, 5) > .5).astype(np.uint8) * 255,
+             (rand.rand(37, 53) > .7).astype(np.uint8) * 255,  # odd-sized noise
+             np.zeros((41, 67), np.uint8)]
+    border = np.zeros((101, 77), np.uint8)  # touching the border
+    border[:30, :] = 255
+    border[:, -9:] = 255
+    masks.append(border)
+    disc = np.zeros((123, 95), np.uint8)  # odd-sized lesion at a corner
+    y, x = np.ogrid[:123, :95]
+    disc[(y - 110) ** 2 + (x - 5) ** 2 < 40 ** 2] = 255
+    masks.append(disc)
+    return masks
+
+
+@pytest.mark.parametrize('backend', sorted(BLUR_ERROR_BOUNDS))
+@pytest.mark.parametrize('sigma', SIGMAS)
+def test_blur_within_error_bound(backend, sigma):
+    for mask in bundled_masks() + synthetic_masks():
+        exact = ndimage.gaussian_filter(mask, sigma=sigma)
+        blurred = blur_mask(mask, sigma, backend)
+        assert blurred.shape == mask.shape and blurred.dtype == mask.dtype
+        error = np.max(np.abs(blurred.astype(int) - exact.astype(int)))
+        assert error <= BLUR_ERROR_BOUNDS[backend], f'{backend} sigma {sigma} mask {mask.shape}: error {error}'
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        blur_mask(np.zeros((4, 4), np.uint8), 2, 'median')
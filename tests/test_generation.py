@@ -0,0 +1,161 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from src import generation, placement
+from src.common import derive_seed, Sampler
+from src.generation import generate_dataset, image_id, settings_fingerprint
+from src.repository import ArtefactsRepository
+from src.types import Bubble, Marking
+from src.writers import PngWriter
+
+META_PATH = 'data/artefacts/meta.json'
+ARTEFACT_CLASSES = [('bubble.png', Bubble), ('marking.png', Marking)]
+SOURCE_IDS = ['ISIC_0024311', 'ISIC_0027001', 'ISIC_0027287']
+
+
+@pytest.fixture
+def pairs(tmp_path):
+    """Downscaled copies of some of the test images and their masks, each one with its own target folder."""
+    pairs = []
+    for identifier in SOURCE_IDS:
+        image = Image.open(f'data/test_images/{identifier}.jpg')
+        size = (image.width // 4, image.height // 4)
+        image.resize(size).save(tmp_path / f'{identifier}.jpg')
+        Image.open(f'data/test_masks/{identifier}.png').resize(size, Image.NEAREST).save(tmp_path / f'{identifier}.png')
+        os.mkdir(tmp_path / identifier)
+        pairs.append((str(tmp_path / f'{identifier}.jpg'), str(tmp_path / f'{identifier}.png'),
+                      str(tmp_path / identifier)))
+    return pairs
+
+
+def test_repository_kwargs_reach_placement(pairs, monkeypatch):
+    backends, cells = [], []
+    blur_mask = placement.blur_mask
+
+    def recording_blur(mask, sigma, backend='exact'):
+        backends.append(backend)
+        return blur_mask(mask, sigma, backend)
+
+    class RecordingSampler(Sampler):
+        def __init__(self, dnf, seed=None, cell_size=1, shape=None):
+            cells.append(cell_size)
+            super().__init__(dnf, seed, cell_size, shape)
+
+    monkeypatch.setattr(placement, 'blur_mask', recording_blur)
+    monkeypatch.setattr(placement, 'Sampler', RecordingSampler)
+
+    settings = {'blur': 'box', 'sampling_cell': 8}
+    list(generate_dataset(pairs, META_PATH, ARTEFACT_CLASSES, root_seed=3, workers=1, repository_kwargs=settings))
+    assert backends and set(backends) == {'box'}
+    assert cells and set(cells) == {8}
+
+    # same result as applying the artefacts of a repository with these settings directly
+    repository = ArtefactsRepository(META_PATH, lazy=True, **settings)
+    image_path, mask_path, target = pairs[0]
+    for name, artefact_class in ARTEFACT_CLASSES:
+        artefact = repository.get_random_instance(artefact_class, seed=derive_seed(3, image_id(image_path), name))
+        expected = artefact(Image.open(image_path), Image.open(mask_path))
+        assert np.array_equal(np.asarray(Image.open(os.path.join(target, name))), np.asarray(expected))
+
+
+@pytest.fixture
+def processed(monkeypatch):
+    """Records the ids of the images artefacts are inserted into (generate_dataset is run with workers=1)."""
+    identifiers = []
+    insert_artefacts = generation.insert_artefacts
+
+    def recording_insert(repository, image, mask, identifier, *args, **kwargs):
+        identifiers.append(identifier)
+        return insert_artefacts(repository, image, mask, identifier, *args, **kwargs)
+
+    monkeypatch.setattr(generation, 'insert_artefacts', recording_insert)
+    return identifiers
+
+
+def generate(pairs, manifest_path, **kwargs):
+    return list(generate_dataset(pairs, META_PATH, ARTEFACT_CLASSES, root_seed=3, workers=1,
+                                 manifest_path=str(manifest_path), **kwargs))
+
+
+def outputs(pairs):
+    return {os.path.join(target, name): np.asarray(Image.open(os.path.join(target, name)))
+            for _, _, target in pairs for name, _ in ARTEFACT_CLASSES}
+
+
+def test_resume_skips_complete_pairs(pairs, processed, tmp_path):
+    generate(pairs, tmp_path / 'manifest.jsonl')
+    assert sorted(processed) == SOURCE_IDS
+    expected = outputs(pairs)
+
+    processed.clear()
+    assert sorted(generate(pairs, tmp_path / 'manifest.jsonl')) == sorted(pair[0] for pair in pairs)
+    assert processed == []
+
+    # a deleted output is generated again, identically, and only its pair is processed
+    deleted = os.path.join(pairs[1][2], 'marking.png')
+    os.remove(deleted)
+    generate(pairs, tmp_path / 'manifest.jsonl')
+    assert processed == [SOURCE_IDS[1]]
+    assert all(np.array_equal(expected[f], image) for f, image in outputs(pairs).items())
+
+
+def test_resume_regenerates_changed_sources(pairs, processed, tmp_path):
+    generate(pairs, tmp_path / 'manifest.jsonl')
+
+    # same content with another modification time: the content is hashed and the pair is still complete
+    processed.clear()
+    stat = os.stat(pairs[0][0])
+    os.utime(pairs[0][0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    generate(pairs, tmp_path / 'manifest.jsonl')
+    assert processed == []
+
+    # changed content (size and modification time)
+    Image.open(pairs[2][0]).rotate(180).save(pairs[2][0], quality=50)
+    os.utime(pairs[2][0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10 ** 9))
+    generate(pairs, tmp_path / 'manifest.jsonl')
+    assert processed == [SOURCE_IDS[2]]
+
+    # changed mask
+    processed.clear()
+    Image.open(pairs[0][1]).transpose(Image.FLIP_LEFT_RIGHT).save(pairs[0][1])
+    generate(pairs, tmp_path / 'manifest.jsonl')
+    assert processed == [SOURCE_IDS[0]]
+
+
+def test_resume_regenerates_on_changed_settings(pairs, processed, tmp_path):
+    generate(pairs, tmp_path / 'manifest.jsonl')
+    processed.clear()
+    generate(pairs, tmp_path / 'manifest.jsonl', repository_kwargs={'blur': 'box'})
+    assert sorted(processed) == SOURCE_IDS
+
+    processed.clear()
+    generate(pairs, tmp_path / 'manifest.jsonl', repository_kwargs={'blur': 'box'}, writer=PngWriter(compress_level=6))
+    assert sorted(processed) == SOURCE_IDS
+
+    processed.clear()
+    generate(pairs, tmp_path / 'manifest.jsonl', repository_kwargs={'blur': 'box'}, writer=PngWriter(compress_level=6))
+    assert processed == []
+
+
+def test_settings_fingerprint_follows_templates(tmp_path):
+    with open(META_PATH) as meta_file:
+        entry = json.load(meta_file)['artefacts'][0]
+    shutil.copytree(os.path.join(os.path.dirname(META_PATH), entry['artefact_folder']),
+                    tmp_path / 'artefacts' / entry['artefact_folder'])
+    meta_path = str(tmp_path / 'artefacts' / 'meta.json')
+    with open(meta_path, 'w') as meta_file:
+        json.dump({'artefacts': [entry]}, meta_file)
+    fingerprint = settings_fingerprint(meta_path)
+    assert settings_fingerprint(meta_path, {'template_cache': str(tmp_path / 'cache')}) == fingerprint
+    assert settings_fingerprint(meta_path, {'warp': 'linear'}) != fingerprint
+
+    image_path = os.path.join(os.path.dirname(meta_path), entry['artefact_folder'],
+                              sorted(os.listdir(tmp_path / 'artefacts' / entry['artefact_folder']))[0])
+    stat = os.stat(image_path)
+    os.utime(image_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert settings_fingerprint(meta_path) != fingerprint
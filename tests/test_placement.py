@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from src.placement import OccupancyIndex, PlacementContext
+from src.repository import ArtefactsRepository
+from src.types import Bubble, MarkingCircle, RulerHorizontal
+
+SEEDS = range(12)
+
+
+@pytest.fixture(scope='module')
+def repository():
+    return ArtefactsRepository('data/artefacts/meta.json', lazy=True)
+
+
+@pytest.fixture(scope='module')
+def image():
+    return np.array(Image.open('data/test_images/ISIC_0024311.jpg'), dtype='int16')
+
+
+@pytest.fixture(scope='module')
+def mask():
+    return Image.open('data/test_masks/ISIC_0024311.png')
+
+
+def placed(artefact):
+    return [a['position'] for a in artefact.last_insertion['artefacts'] if a['position'] is not None]
+
+
+def test_occupancy_index():
+    index = OccupancyIndex((100, 80))
+    index.add((10, 10), (30, 40))
+    assert len(index) == 1
+    assert index.overlaps((29, 39), (50, 50))
+    assert not index.overlaps((30, 10), (50, 40))  # ends are exclusive
+    assert not index.overlaps((-20, -20), (0, 0))  # outside of the image
+    index.add((-5, 70), (5, 200))  # clipped to the image
+    assert index.overlaps((0, 79), (1, 80))
+    start, end = OccupancyIndex.extent(np.zeros((5, 8)), (20, 30))
+    assert tuple(start) == (18, 26) and tuple(end) == (23, 34)
+
+
+def test_later_artefact_avoids_occupied_regions(repository, image, mask):
+    overlapping, total = 0, 0
+    for seed in SEEDS:
+        context = PlacementContext(image, mask).with_occupancy()
+        repository.get_random_instance(MarkingCircle, seed=seed)(image, context)
+        occupied = OccupancyIndex(image.shape)
+        for rectangle in context.occupancy._rectangles:
+            occupied.add(rectangle[0:2], rectangle[2:4])
+
+        bubble = repository.get_random_instance(Bubble, seed=seed)
+        bubble(image, context)
+        new = context.occupancy._rectangles[len(occupied):]
+        assert len(new) == len(placed(bubble))
+        assert not any(occupied.overlaps(r[0:2], r[2:4]) for r in new)
+        total += len(new)
+
+        # the same bubbles placed without a shared occupancy index do overlap the marking
+        bubble.reseed(seed)
+        bubble(image, PlacementContext(image, mask))
+        overlapping += sum(occupied.overlaps(*OccupancyIndex.extent(np.zeros((1, 1)), pos)) for pos in placed(bubble))
+    assert total > 0 and overlapping > 0
+
+
+def test_placement_when_every_candidate_is_occupied(repository, image, mask):
+    for seed in SEEDS:
+        context = PlacementContext(image, mask).with_occupancy()
+        context.occupancy.add((0, 0), image.shape[0:2])
+
+        # bubbles are left out
+        bubble = repository.get_random_instance(Bubble, seed=seed)
+        assert np.array_equal(bubble(image, context, return_type='ndarray'), image)
+        assert placed(bubble) == []
+
+        # horizontal rulers and circle markings are placed regardless
+        for artefact_class in (RulerHorizontal, MarkingCircle):
+            artefact = repository.get_random_instance(artefact_class, seed=seed)
+            result = artefact(image, context, return_type='ndarray')
+            assert len(placed(artefact)) == len(artefact.last_insertion['artefacts']) == 1
+            assert not np.array_equal(result, image)
+        assert len(context.occupancy) == 3
@@ -0,0 +1,61 @@
+import random
+
+import numpy as np
+import pytest
+
+from src.common import beta_distribution, Sampler
+
+SHAPES = [(5, 7), (37, 53), (120, 90)]
+
+
+def distributions(shape, cell_size):
+    rand = np.random.RandomState(1)
+    beta = beta_distribution(shape, cell_size=cell_size)
+    sparse = beta * (rand.rand(*beta.shape) > .7)  # zero probability cells
+    sparse.flat[0] = 1e-3
+    return [beta, sparse]
+
+
+def baseline_rand2d(dnf, rand):
+    """Position drawn by the original implementation (a linear search of the cumulative distribution)."""
+    cdf = np.cumsum(dnf.astype(np.float64))
+    index = np.argmax(cdf / cdf.max() > rand.random())
+    r = int(index / dnf.shape[1])
+    return r, index - r * dnf.shape[1]
+
+
+@pytest.mark.parametrize('cell_size', [1, 8])
+@pytest.mark.parametrize('shape', SHAPES)
+def test_batch_equals_consecutive_draws(shape, cell_size):
+    for dnf in distributions(shape, cell_size):
+        for seed in range(3):
+            batch = Sampler(dnf.copy(), seed, cell_size=cell_size, shape=shape).rand2d_batch(25)
+            sampler = Sampler(dnf.copy(), seed, cell_size=cell_size, shape=shape)
+            single = [sampler.rand2d() for _ in range(25)]
+            assert batch.shape == (25, 2)
+            assert [tuple(int(x) for x in pos) for pos in batch] == single
+            assert np.all(batch >= 0) and np.all(batch < shape)
+
+            # successive batches continue the sequence
+            sampler = Sampler(dnf.copy(), seed, cell_size=cell_size, shape=shape)
+            assert np.array_equal(np.concatenate([sampler.rand2d_batch(10), sampler.rand2d_batch(15)]), batch)
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_seeded_draws_unchanged(shape):
+    for dnf in distributions(shape, 1):
+        for seed in range(3):
+            rand = random.Random(seed)
+            expected = [baseline_rand2d(dnf, rand) for _ in range(25)]
+            sampler = Sampler(dnf.copy(), seed)
+            assert [sampler.rand2d() for _ in range(25)] == expected
+
+
+def test_cells_are_drawn_with_their_probability():
+    dnf = np.zeros((4, 5))
+    dnf[1, 2], dnf[3, 4] = 1, 3  # the last cell only partially covers the image
+    positions = Sampler(dnf, 0, cell_size=8, shape=(30, 37)).rand2d_batch(4000)
+    cells = positions // 8
+    assert set(map(tuple, cells)) == {(1, 2), (3, 4)}
+    assert abs(np.mean(np.all(cells == (3, 4), axis=1)) - .75) < .03
+    assert positions[:, 0].max() < 30 and positions[:, 1].max() < 37
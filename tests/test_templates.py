@@ -0,0 +1,85 @@
+import glob
+import json
+import os
+import shutil
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from src import templates
+from src.templates import load_templates, template_sources_key, TemplateStore
+
+FOLDERS = ['src/ISIC_0024688', 'src/ISIC_0025309']  # a bubble (difference preprocessor) and a spot marking
+
+
+@pytest.fixture
+def artefacts(tmp_path):
+    """Copy of two artefacts of the bundled meta.json file, so their images can be modified."""
+    with open('data/artefacts/meta.json') as meta_file:
+        entries = [e for e in json.load(meta_file)['artefacts'] if e['artefact_folder'] in FOLDERS]
+    for folder in FOLDERS:
+        shutil.copytree(os.path.join('data/artefacts', folder), tmp_path / 'artefacts' / folder)
+    meta_path = str(tmp_path / 'artefacts' / 'meta.json')
+    with open(meta_path, 'w') as meta_file:
+        json.dump({'artefacts': entries}, meta_file)
+    return meta_path, entries
+
+
+def data_files(store_path):
+    return sorted(os.path.basename(f) for f in glob.glob(os.path.join(store_path, 'templates-*.npy')))
+
+
+def assert_templates(store, meta_path, entries):
+    assert len(store) == len(entries)
+    for i, entry in enumerate(entries):
+        expected = load_templates(entry, os.path.dirname(meta_path))
+        assert len(store.templates(i)) == len(expected)
+        assert all(np.array_equal(t, e) and t.dtype == e.dtype for t, e in zip(store.templates(i), expected))
+
+
+def test_store_is_rebuilt_when_sources_change(artefacts, tmp_path, monkeypatch):
+    meta_path, entries = artefacts
+    store_path = str(tmp_path / 'store')
+    store = TemplateStore(store_path, meta_path, entries)
+    assert_templates(store, meta_path, entries)
+    assert data_files(store_path) == [f'templates-{store.key[:16]}.npy']
+
+    # an up to date store is reused, templates are not loaded again
+    with monkeypatch.context() as m:
+        m.setattr(templates, 'load_templates', lambda *args: pytest.fail('templates loaded again'))
+        assert TemplateStore(store_path, meta_path, entries).key == store.key
+
+    # a touched image changes the key and the store is rebuilt, the data of the outdated store is removed
+    image_path = sorted(glob.glob(os.path.join(os.path.dirname(meta_path), FOLDERS[1], '*.png')))[0]
+    stat = os.stat(image_path)
+    os.utime(image_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert template_sources_key(meta_path, entries) != store.key
+    touched = TemplateStore(store_path, meta_path, entries)
+    assert touched.key != store.key
+    assert data_files(store_path) == [f'templates-{touched.key[:16]}.npy']
+    assert_templates(touched, meta_path, entries)
+
+    # a modified image is reflected by the rebuilt templates
+    image = np.array(Image.open(image_path))
+    image[0:20, 0:20, 0:3] = 0
+    Image.fromarray(image).save(image_path)
+    modified = TemplateStore(store_path, meta_path, entries)
+    assert modified.key not in (store.key, touched.key)
+    assert data_files(store_path) == [f'templates-{modified.key[:16]}.npy']
+    assert_templates(modified, meta_path, entries)
+    assert not np.array_equal(modified.templates(1)[0], touched.templates(1)[0])
+
+
+def test_store_is_rebuilt_when_meta_changes(artefacts, tmp_path):
+    meta_path, entries = artefacts
+    store_path = str(tmp_path / 'store')
+    store = TemplateStore(store_path, meta_path, entries)
+
+    entries = entries[::-1]
+    with open(meta_path, 'w') as meta_file:
+        json.dump({'artefacts': entries}, meta_file)
+    reordered = TemplateStore(store_path, meta_path, entries)
+    assert reordered.key != store.key
+    assert data_files(store_path) == [f'templates-{reordered.key[:16]}.npy']
+    assert_templates(reordered, meta_path, entries)
@@ -0,0 +1,97 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from src.common import warp_artefact, SparseArtefact, WARP_ORDERS
+from src.repository import ArtefactsRepository
+from src.types import Artefact
+
+# tolerance of the single-interpolation warp modes compared to the chained transformation (relative L1 difference
+# of the transformed templates). The chained transformation interpolates (and smooths) up to three times, so the
+# results differ most for small, high-contrast templates (e.g. bubbles) and fine patterns (e.g. ruler ticks), while
+# the placement is the same. Measured on the templates below: linear 0.125 mean, 0.41 max; nearest 0.27 mean, 0.67 max.
+RELATIVE_L1_BOUNDS = {'linear': {'mean': .15, 'max': .5},
+                      'nearest': {'mean': .32, 'max': .75}}
+
+FLIPS = [None, 0, 1]
+SCALES = [None, .6, 1.3]
+ANGLES = [None, 30, 135, 290]
+RESOLUTION_SCALES = [None, (.5, .5), (.4, .6)]
+
+
+def dense(artefact):
+    if isinstance(artefact, SparseArtefact):
+        result = np.zeros(artefact.shape)
+        result[artefact.rows, artefact.cols] = artefact.values
+        return result
+    return np.asarray(artefact, dtype=float)
+
+
+def embedded(artefact, shape):
+    """Places the artefact centered (see embed_in_image) on an empty canvas of the given shape."""
+    canvas = np.zeros((*shape, 3))
+    start = np.array(shape) // 2 - np.array(artefact.shape[0:2]) // 2
+    canvas[start[0]:start[0] + artefact.shape[0], start[1]:start[1] + artefact.shape[1]] = artefact
+    return canvas
+
+
+def arrow():
+    """Asymmetric synthetic template, so errors in flips, rotation direction or centering are detected."""
+    template = np.zeros((21, 41, 3), dtype='int16')
+    template[8:13, 4:37] = -80
+    template[5:16, 30:37] = -160
+    template[2:6, 4:8] = 120
+    return template
+
+
+@pytest.fixture(scope='module')
+def templates():
+    repository = ArtefactsRepository('data/artefacts/meta.json', lazy=True)
+    selected = [arrow()]
+    for artefact in repository.artefacts:
+        t = artefact._template(0)
+        if max(t.shape[0:2]) <= 200:  # keep the chained transformation fast
+            selected.append(t)
+    return selected[::4]
+
+
+def compare(template, flip, scale, angle, resolution_scale, mode):
+    chained = dense(Artefact._transform_artefact(template, flip, scale, angle, resolution_scale, 'chained'))
+    warped = dense(Artefact._transform_artefact(template, flip, scale, angle, resolution_scale, mode))
+    # the trimmed shapes may differ by a few pixels, as faint borders are smoothed to zero differently
+    shape = np.maximum(chained.shape[0:2], warped.shape[0:2]) + 8
+    chained, warped = embedded(chained, shape), embedded(warped, shape)
+    # the artefacts are placed at the same position: no shift of the warped artefact matches better
+    errors = {(dr, dc): np.abs(np.roll(warped, (dr, dc), axis=(0, 1)) - chained).sum()
+              for dr, dc in itertools.product((-1, 0, 1), repeat=2)}
+    assert errors[(0, 0)] == min(errors.values())
+    return errors[(0, 0)] / max(np.abs(chained).sum(), 1)
+
+
+@pytest.mark.parametrize('mode', sorted(WARP_ORDERS))
+def test_warp_matches_chained_transformation(templates, mode):
+    errors = [compare(t, flip, scale, angle, resolution_scale, mode)
+              for t in templates
+              for flip, scale, angle, resolution_scale in itertools.product(FLIPS, SCALES, ANGLES, RESOLUTION_SCALES)
+              if (scale, angle, resolution_scale) != (None, None, None)]
+    assert np.mean(errors) <= RELATIVE_L1_BOUNDS[mode]['mean']
+    assert np.max(errors) <= RELATIVE_L1_BOUNDS[mode]['max']
+
+
+@pytest.mark.parametrize('mode', sorted(WARP_ORDERS))
+def test_flip_is_exact(mode):
+    for flip in FLIPS:
+        chained = dense(Artefact._transform_artefact(arrow(), flip, warp='chained'))
+        assert np.array_equal(chained, dense(Artefact._transform_artefact(arrow(), flip, warp=mode)))
+
+
+def test_warp_without_transformation_is_identity():
+    template = arrow()
+    assert np.allclose(warp_artefact(template), template)
+    assert warp_artefact(template).dtype == np.float32
+
+
+def test_unknown_warp_mode():
+    with pytest.raises(ValueError):
+        warp_artefact(arrow(), mode='cubic')
@@ -0,0 +1,80 @@
+import glob
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from src.generation import generate_dataset, image_id, insert_artefacts
+from src.repository import ArtefactsRepository
+from src.types import Bubble, Ruler
+from src.writers import NpyShardWriter, TarShardWriter, read_shards
+
+META_PATH = 'data/artefacts/meta.json'
+ARTEFACT_CLASSES = [('bubble.png', Bubble), ('ruler.png', Ruler)]
+WRITERS = {'tar-npy': lambda target: TarShardWriter(target, shard_size=2),
+           'tar-png': lambda target: TarShardWriter(target, shard_size=2, image_format='png'),
+           'npy': lambda target: NpyShardWriter(target, shard_size=2)}
+
+
+@pytest.fixture(scope='module')
+def pairs(tmp_path_factory):
+    """Downscaled copies of the test images, the last one without mask."""
+    folder = tmp_path_factory.mktemp('sources')
+    pairs = []
+    for image_path in sorted(glob.glob('data/test_images/*.jpg')):
+        identifier = image_id(image_path)
+        image = Image.open(image_path)
+        size = (image.width // 4, image.height // 4)
+        image.resize(size).save(folder / f'{identifier}.jpg')
+        mask_path = str(folder / f'{identifier}.png')
+        Image.open(f'data/test_masks/{identifier}.png').resize(size, Image.NEAREST).save(mask_path)
+        pairs.append((str(folder / f'{identifier}.jpg'), mask_path, None))
+    pairs[-1] = (pairs[-1][0], None, None)
+    return pairs
+
+
+def read_dataset(pairs, writer, workers):
+    list(generate_dataset(pairs, META_PATH, ARTEFACT_CLASSES, root_seed=5, workers=workers, writer=writer))
+    shards = sorted(glob.glob(os.path.join(writer.target_dir, f'*{writer.extension}')))
+    assert len(shards) == (len(pairs) + writer.shard_size - 1) // writer.shard_size
+    return list(read_shards(shards))
+
+
+@pytest.mark.parametrize('kind', sorted(WRITERS))
+def test_shards_round_trip(pairs, tmp_path, kind):
+    os.mkdir(tmp_path / 'single')
+    os.mkdir(tmp_path / 'pool')
+    samples = read_dataset(pairs, WRITERS[kind](str(tmp_path / 'single')), workers=1)
+    assert [s['id'] for s in samples] == [image_id(pair[0]) for pair in pairs]
+
+    repository = ArtefactsRepository(META_PATH, lazy=True)
+    for sample, (image_path, mask_path, _) in zip(samples, pairs):
+        image = Image.open(image_path)
+        mask = Image.open(mask_path) if mask_path else None
+        assert np.array_equal(sample['image'], np.asarray(image))
+        assert (sample['mask'] is None) if mask is None else np.array_equal(sample['mask'], np.asarray(mask))
+
+        expected = insert_artefacts(repository, image, mask, sample['id'], ARTEFACT_CLASSES, root_seed=5)
+        assert sorted(sample['images']) == ['bubble', 'ruler']
+        assert sample['meta']['id'] == sample['id']
+        assert (sample['meta']['image'], sample['meta']['mask']) == (image_path, mask_path)
+        for name, result, insertion in expected:
+            key = os.path.splitext(name)[0]
+            assert np.array_equal(sample['images'][key], np.asarray(result))
+            assert sample['meta']['artefacts'][key] == insertion
+
+    # the output does not depend on the number of workers
+    pooled = read_dataset(pairs, WRITERS[kind](str(tmp_path / 'pool')), workers=2)
+    assert len(pooled) == len(samples)
+    for a, b in zip(samples, pooled):
+        assert a['id'] == b['id'] and a['meta'] == b['meta']
+        for name in ('image', 'mask'):
+            assert (a[name] is None and b[name] is None) or np.array_equal(a[name], b[name])
+        assert a['images'].keys() == b['images'].keys()
+        assert all(np.array_equal(a['images'][k], b['images'][k]) for k in a['images'])
+
+
+def test_unknown_image_format(tmp_path):
+    with pytest.raises(ValueError):
+        TarShardWriter(str(tmp_path), image_format='jpg')